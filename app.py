@@ -1,19 +1,35 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, Response
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, 
-    FlexSendMessage, BubbleContainer, BoxComponent,
-    TextComponent, ButtonComponent, URIAction,
-    CarouselContainer
+    BubbleContainer, BoxComponent,
+    TextComponent, ButtonComponent, URIAction
 )
 import os
 import json
 import requests
-from bs4 import BeautifulSoup
 import logging
-import traceback
-import re
+import time
+import atexit
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from event_queue import EventQueue
+from search_cache import SearchCache
+from negative_cache import NegativeCache
+from singleflight import SingleFlight
+from http_session import SiteSession
+from extract import moppy_stream_extractor, scan_moppy_results
+from extract_pool import ExtractionPool
+from catalog import CatalogIndex, DEFAULT_HAPITAS_ADS, load_catalog
+from normalize import Normalizer, canonicalize as default_canonicalize, clean_query, load_synonyms
+from snapshot_store import SnapshotStore
+from metrics import MetricsRegistry
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from flex_render import RenderedFlexSendMessage, render_carousel
+from log_setup import BodySampler, setup_logging
+from popularity import KeywordSketch, PrefetchScheduler
+from rate_limit import KeyedRateLimiter, RateLimitedError, TokenBucket
 
 app = Flask(__name__)
 
@@ -21,16 +37,249 @@ app = Flask(__name__)
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', 'YOUR_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', 'YOUR_CHANNEL_SECRET')
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# LINE Messaging APIの接続先（負荷試験で loadtest.py のスタブに向ける場合に変更する）
+LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', 'https://api.line.me')
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-# ロギング設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# ロギング設定（出力はバックグラウンドのスレッドで行い、リクエストボディは一部だけ伏せ字にして記録する）
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_BODY_SAMPLE_RATE = float(os.environ.get('LOG_BODY_SAMPLE_RATE', '0.01'))
+LOG_REDACT_FIELDS = [f for f in os.environ.get('LOG_REDACT_FIELDS', 'replyToken,userId,groupId,roomId').split(',') if f]
+
+log_handler, log_listener = setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT)
+body_sampler = BodySampler(LOG_BODY_SAMPLE_RATE, LOG_REDACT_FIELDS)
 logger = logging.getLogger(__name__)
 
+# メトリクス（GET /metrics でPrometheusのテキスト形式で返す）
+metrics = MetricsRegistry()
+search_stage_seconds = metrics.histogram(
+    'linebot_search_stage_seconds', 'Time spent in each search stage per site (fetch, parse, match, snapshot, total)'
+)
+reply_stage_seconds = metrics.histogram('linebot_reply_stage_seconds', 'Time spent building (flex) and sending (reply) replies')
+handle_message_seconds = metrics.histogram('linebot_handle_message_seconds', 'Total time spent handling a text message')
+search_errors_total = metrics.counter('linebot_search_errors_total', 'Site searches that raised an error')
+search_timeouts_total = metrics.counter('linebot_search_timeouts_total', 'Site searches that missed the search deadline')
+
+# 並列検索の設定（全サイト共通の締め切り秒数とスレッド数）
+SEARCH_DEADLINE_SECONDS = float(os.environ.get('SEARCH_DEADLINE_SECONDS', '8'))
+SEARCH_MAX_WORKERS = int(os.environ.get('SEARCH_MAX_WORKERS', '8'))
+
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix='search')
+
+# モッピーの検索ページ（負荷試験で loadtest.py のスタブに向ける場合に変更する）
+MOPPY_SEARCH_URL = os.environ.get('MOPPY_SEARCH_URL', "https://pc.moppy.jp/search")
+
+# サイト取得用HTTPセッションの設定（接続プールは検索スレッド数に合わせる）
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF_SECONDS = float(os.environ.get('HTTP_BACKOFF_SECONDS', '0.3'))
+
+site_session = SiteSession(
+    pool_size=SEARCH_MAX_WORKERS,
+    retries=HTTP_RETRIES,
+    backoff_factor=HTTP_BACKOFF_SECONDS
+)
+
+# HTMLの抽出をワーカープロセスで行うプール（EXTRACT_POOL_SIZE=0で無効。検索スレッドでそのまま抽出する）
+EXTRACT_POOL_SIZE = int(os.environ.get('EXTRACT_POOL_SIZE', '0'))
+EXTRACT_POOL_TIMEOUT_SECONDS = float(os.environ.get('EXTRACT_POOL_TIMEOUT_SECONDS', '5'))
+EXTRACT_POOL_MAX_TASKS_PER_WORKER = int(os.environ.get('EXTRACT_POOL_MAX_TASKS_PER_WORKER', '200'))
+
+extraction_pool = ExtractionPool(
+    size=EXTRACT_POOL_SIZE,
+    timeout=EXTRACT_POOL_TIMEOUT_SECONDS,
+    max_tasks_per_worker=EXTRACT_POOL_MAX_TASKS_PER_WORKER
+) if EXTRACT_POOL_SIZE > 0 else None
+if extraction_pool is not None:
+    atexit.register(extraction_pool.close)
+scan_moppy = extraction_pool.scanner('moppy') if extraction_pool is not None else scan_moppy_results
+
+# サイトごとのサーキットブレーカー（連続で失敗したサイトはしばらく呼び出さずに即座に失敗させる）
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '30'))
+# サイト取得のタイムアウトは最近の応答時間（p95の2倍）に合わせ、この範囲に収める
+SITE_TIMEOUT_MIN_SECONDS = float(os.environ.get('SITE_TIMEOUT_MIN_SECONDS', '1'))
+SITE_TIMEOUT_MAX_SECONDS = float(os.environ.get('SITE_TIMEOUT_MAX_SECONDS', '10'))
+
+site_breakers = {
+    'moppy': CircuitBreaker(
+        'moppy',
+        failure_threshold=BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=BREAKER_RESET_SECONDS,
+        min_timeout=SITE_TIMEOUT_MIN_SECONDS,
+        max_timeout=SITE_TIMEOUT_MAX_SECONDS
+    ),
+}
+
+# 流量制限（ユーザーごとの検索回数と、サイトへのライブ取得全体の予算）。レートを0にすると制限しない
+USER_RATE_PER_MINUTE = float(os.environ.get('USER_RATE_PER_MINUTE', '10'))
+USER_RATE_BURST = int(os.environ.get('USER_RATE_BURST', '5'))
+USER_RATE_MAX_USERS = int(os.environ.get('USER_RATE_MAX_USERS', '10000'))
+LIVE_FETCH_RATE_PER_SECOND = float(os.environ.get('LIVE_FETCH_RATE_PER_SECOND', '5'))
+LIVE_FETCH_BURST = int(os.environ.get('LIVE_FETCH_BURST', '10'))
+
+user_limiter = KeyedRateLimiter(USER_RATE_PER_MINUTE / 60.0, USER_RATE_BURST, max_keys=USER_RATE_MAX_USERS)
+live_fetch_budget = TokenBucket(LIVE_FETCH_RATE_PER_SECOND, LIVE_FETCH_BURST)
+
+# 検索結果キャッシュの設定（SEARCH_CACHE_SIZE=0で無効）
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '1000'))
+SEARCH_CACHE_TTL_SECONDS = float(os.environ.get('SEARCH_CACHE_TTL_SECONDS', '300'))
+# TTL切れ後もこの秒数までは古い結果を返しつつバックグラウンドで更新する
+SEARCH_CACHE_STALE_SECONDS = float(os.environ.get('SEARCH_CACHE_STALE_SECONDS', '600'))
+
+# 検索結果が0件だったサイト・キーワードを覚えておく秒数（NEGATIVE_CACHE_TTL_SECONDS=0で無効。0件の結果も通常のキャッシュに保存する）
+NEGATIVE_CACHE_TTL_SECONDS = float(os.environ.get('NEGATIVE_CACHE_TTL_SECONDS', '60'))
+NEGATIVE_CACHE_CAPACITY = int(os.environ.get('NEGATIVE_CACHE_CAPACITY', '10000'))
+NEGATIVE_CACHE_FALSE_POSITIVE_RATE = float(os.environ.get('NEGATIVE_CACHE_FALSE_POSITIVE_RATE', '0.001'))
+
+negative_cache = NegativeCache(
+    ttl=NEGATIVE_CACHE_TTL_SECONDS,
+    capacity=NEGATIVE_CACHE_CAPACITY,
+    false_positive_rate=NEGATIVE_CACHE_FALSE_POSITIVE_RATE
+) if NEGATIVE_CACHE_TTL_SECONDS > 0 else None
+
+search_cache = SearchCache(
+    maxsize=SEARCH_CACHE_SIZE,
+    ttl=SEARCH_CACHE_TTL_SECONDS,
+    stale_ttl=SEARCH_CACHE_STALE_SECONDS,
+    cache_empty=negative_cache is None
+)
+
+# 検索キーワードの正規化（SYNONYMS_PATHで表記ゆれの表をJSONファイルから追加できる）
+SYNONYMS_PATH = os.environ.get('SYNONYMS_PATH')
+
+canonicalize = Normalizer(load_synonyms(SYNONYMS_PATH)) if SYNONYMS_PATH else default_canonicalize
+
+# ハピタスの広告カタログ（HAPITAS_CATALOG_PATHでJSON/CSVファイルを指定できる）
+HAPITAS_CATALOG_PATH = os.environ.get('HAPITAS_CATALOG_PATH')
+
+hapitas_catalog = CatalogIndex(
+    load_catalog(HAPITAS_CATALOG_PATH) if HAPITAS_CATALOG_PATH else DEFAULT_HAPITAS_ADS,
+    normalize=canonicalize
+)
+
+# クローラー（crawler.py）が保存した広告一覧のストア。指定した場合はライブ検索より優先する
+SNAPSHOT_DB_PATH = os.environ.get('SNAPSHOT_DB_PATH')
+# これより古い保存データは使わない（秒）
+SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get('SNAPSHOT_MAX_AGE_SECONDS', '86400'))
+
+snapshot_store = SnapshotStore(SNAPSHOT_DB_PATH, normalize=canonicalize) if SNAPSHOT_DB_PATH else None
+
+# 同じサイト・キーワードの同時検索を1回の取得にまとめる
+single_flight = SingleFlight()
+
+# よく検索されるキーワードの集計（POPULAR_KEYWORDS_PATH を指定すると再起動後も引き継ぐ）
+POPULAR_KEYWORDS_PATH = os.environ.get('POPULAR_KEYWORDS_PATH')
+POPULAR_KEYWORDS_CAPACITY = int(os.environ.get('POPULAR_KEYWORDS_CAPACITY', '500'))
+# 上位のキーワードの検索結果を起動時と一定間隔ごとに先読みする（PREFETCH_INTERVAL_SECONDS=0で無効）
+PREFETCH_TOP_N = int(os.environ.get('PREFETCH_TOP_N', '30'))
+PREFETCH_INTERVAL_SECONDS = float(os.environ.get('PREFETCH_INTERVAL_SECONDS', '240'))
+PREFETCH_DELAY_SECONDS = float(os.environ.get('PREFETCH_DELAY_SECONDS', '0.5'))
+PREFETCH_DECAY = float(os.environ.get('PREFETCH_DECAY', '0.9'))
+
+keyword_sketch = KeywordSketch(capacity=POPULAR_KEYWORDS_CAPACITY)
+if POPULAR_KEYWORDS_PATH:
+    keyword_sketch.load(POPULAR_KEYWORDS_PATH)
+
+metrics.callback(
+    'linebot_search_cache_lookups_total', 'Search cache lookups by result',
+    lambda: [
+        ({'result': 'hit'}, search_cache.hits),
+        ({'result': 'stale'}, search_cache.stale_hits),
+        ({'result': 'miss'}, search_cache.misses),
+    ],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_circuit_breaker_state', 'Circuit breaker state per site (0=closed, 1=half_open, 2=open)',
+    lambda: [
+        ({'site': site}, {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[breaker.state])
+        for site, breaker in site_breakers.items()
+    ]
+)
+metrics.callback(
+    'linebot_site_timeout_seconds', 'Current adaptive fetch timeout per site',
+    lambda: [({'site': site}, breaker.timeout()) for site, breaker in site_breakers.items()]
+)
+metrics.callback(
+    'linebot_negative_cache_lookups_total', 'Negative (zero-result) cache lookups by result',
+    lambda: [] if negative_cache is None else [
+        ({'result': 'hit'}, negative_cache.hits),
+        ({'result': 'miss'}, negative_cache.misses),
+    ],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_negative_cache_false_positive_rate', 'Estimated false-positive rate of the negative cache',
+    lambda: [] if negative_cache is None else [({}, negative_cache.stats()['false_positive_rate'])]
+)
+metrics.callback(
+    'linebot_negative_cache_memory_bytes', 'Memory used by the negative cache bit arrays',
+    lambda: [] if negative_cache is None else [({}, negative_cache.stats()['memory_bytes'])]
+)
+metrics.callback('linebot_search_cache_entries', 'Entries in the search cache', lambda: [({}, search_cache.stats()['size'])])
+metrics.callback(
+    'linebot_single_flight_coalesced_total', 'Searches that shared an in-flight fetch',
+    lambda: [({}, single_flight.coalesced)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_rate_limited_total', 'Requests rejected by rate limits (user: per-user messages, live_fetch: global site fetch budget)',
+    lambda: [({'limit': 'user'}, user_limiter.rejected), ({'limit': 'live_fetch'}, live_fetch_budget.rejected)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_log_records_dropped_total', 'Log records dropped because the log queue was full',
+    lambda: [({}, log_handler.dropped)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_http_not_modified_total', 'Site fetches answered with 304 Not Modified',
+    lambda: [({}, site_session.not_modified)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_extract_pool_jobs_total', 'HTML extractions run in the worker process pool by result',
+    lambda: [] if extraction_pool is None else [
+        ({'result': 'ok'}, extraction_pool.completed),
+        ({'result': 'timeout'}, extraction_pool.timeouts),
+        ({'result': 'error'}, extraction_pool.errors),
+    ],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_http_stopped_early_total', 'Site fetches closed before the end of the body because the top results were found',
+    lambda: [({}, site_session.stopped_early)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_http_retries_total', 'Site fetches retried after a connection error, timeout or 429/5xx response',
+    lambda: [({}, site_session.retried)],
+    type_name='counter'
+)
+metrics.callback(
+    'linebot_http_body_bytes_total', 'Decoded response body bytes read from sites',
+    lambda: [({}, site_session.bytes_read)],
+    type_name='counter'
+)
+
+# Webhookの非同期処理モード（1にすると署名検証後すぐに200を返し、イベントはキューで処理する）
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '0') == '1'
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '100'))
+# 応答トークンの有効期限（秒）。これより古いイベントは返信できないため破棄する
+REPLY_TOKEN_MAX_AGE_SECONDS = float(os.environ.get('REPLY_TOKEN_MAX_AGE_SECONDS', '50'))
+
+# 1回の配信に含まれる複数イベントを並列に処理する数（同じユーザーのイベントは順番に処理する）
+WEBHOOK_DISPATCH_CONCURRENCY = int(os.environ.get('WEBHOOK_DISPATCH_CONCURRENCY', '4'))
+
+# ASGI版（asgi.py）で同時に処理するイベントのグループ（送信元ごと）の数
+ASGI_MAX_CONCURRENT_EVENTS = int(os.environ.get('ASGI_MAX_CONCURRENT_EVENTS', '100'))
+
+dispatch_executor = ThreadPoolExecutor(max_workers=max(1, WEBHOOK_DISPATCH_CONCURRENCY), thread_name_prefix='dispatch')
+
 @app.route("/callback", methods=['POST'])
 def callback():
     """LINE Webhookからのコールバックを処理する"""
@@ -39,313 +288,434 @@ def callback():
 
     # リクエストボディを取得
     body = request.get_data(as_text=True)
-    logger.info("Request body: %s", body)
+    sampled_body = body_sampler.sample(body)
+    if sampled_body is not None:
+        logger.info("Request body", extra={'body': sampled_body})
 
     # Webhookを処理
     try:
-        handler.handle(body, signature)
+        if WEBHOOK_ASYNC:
+            enqueue_events(body, signature)
+        else:
+            dispatch_events(handler.parser.parse(body, signature))
     except InvalidSignatureError:
         logger.error("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
     except Exception as e:
-        logger.error(f"Unexpected error in callback: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unexpected error in callback: %s", e)
         abort(500)
 
     return 'OK'
 
+@app.route("/health", methods=['GET'])
+def health():
+    """稼働状況とイベントキューの深さを返す"""
+    return jsonify({
+        'status': 'ok',
+        'webhook_async': WEBHOOK_ASYNC,
+        'event_queue': event_queue.stats(),
+        'search_cache': search_cache.stats(),
+        'negative_cache': negative_cache.stats() if negative_cache is not None else None,
+        'single_flight': single_flight.stats(),
+        'http_session': site_session.stats(),
+        'extraction_pool': extraction_pool.stats() if extraction_pool is not None else None,
+        'circuit_breakers': {site: breaker.stats() for site, breaker in site_breakers.items()},
+        'prefetch': prefetch_scheduler.stats(),
+        'rate_limits': {'user': user_limiter.stats(), 'live_fetch': live_fetch_budget.stats()}
+    })
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """メトリクスをPrometheusのテキスト形式で返す"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def enqueue_events(body, signature):
+    """署名を検証してイベントをキューに積む（満杯の場合はその場で処理する）
+
+    キューは送信元ごとに分かれていて、同じ送信元のイベントは積んだ順に処理される。
+    """
+    events = handler.parser.parse(body, signature)
+    # キューに積めなかった送信元（この配信の残りのイベントもその場で処理して順序を保つ）
+    inline_sources = set()
+    for event in events:
+        source = event_source_key(event)
+        if source in inline_sources or not event_queue.submit(event):
+            # キューが満杯の場合はリクエストスレッドで処理して流入を抑える
+            inline_sources.add(source)
+            dispatch_in_order([event])
+
+def event_source_key(event):
+    """イベントの送信元（ユーザー・グループ・トークルーム）を表すキーを返す"""
+    source = getattr(event, 'source', None)
+    for attr in ('user_id', 'group_id', 'room_id'):
+        source_id = getattr(source, attr, None)
+        if source_id:
+            return source_id
+    return id(event)
+
+def dispatch_events(events):
+    """1回の配信に含まれるイベントを、送信元ごとの順序を保ったまま並列に処理する"""
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault(event_source_key(event), []).append(event)
+
+    if len(groups) <= 1 or WEBHOOK_DISPATCH_CONCURRENCY <= 1:
+        dispatch_in_order(events)
+        return
+
+    futures = [dispatch_executor.submit(dispatch_in_order, group) for group in groups.values()]
+    wait(futures)
+
+def dispatch_in_order(events):
+    """イベントを順番に処理する（1件が失敗しても残りは処理する）"""
+    for event in events:
+        try:
+            dispatch_event(event)
+        except Exception as e:
+            logger.exception("Unexpected error while dispatching event: %s", e)
+
+def dispatch_event(event):
+    """パース済みのイベントを対応するハンドラに渡す"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+
+event_queue = EventQueue(
+    dispatch_event,
+    workers=WEBHOOK_WORKERS,
+    maxsize=WEBHOOK_QUEUE_SIZE,
+    max_event_age=REPLY_TOKEN_MAX_AGE_SECONDS,
+    key=event_source_key
+)
+
+metrics.callback('linebot_event_queue_depth', 'Events waiting in the webhook queue', lambda: [({}, event_queue.stats()['depth'])])
+metrics.callback(
+    'linebot_event_queue_dropped_total', 'Webhook events rejected or dropped by the queue',
+    lambda: [({'reason': 'full'}, event_queue.rejected), ({'reason': 'stale'}, event_queue.dropped_stale)],
+    type_name='counter'
+)
+
+# ユーザーへの返信文（ASGI版の asgi.py と共通）
+INVALID_KEYWORD_TEXT = "検索ワードは1〜100文字で入力してください。"
+NOT_FOUND_TEXT = "「{keyword}」に関する検索結果が見つかりませんでした。別のキーワードで試してみてください。"
+NETWORK_ERROR_TEXT = "検索中にネットワークエラーが発生しました。しばらく経ってからもう一度お試しください。"
+UNEXPECTED_ERROR_TEXT = "予期せぬエラーが発生しました。しばらく経ってからもう一度お試しください。"
+THROTTLED_TEXT = "短時間に検索が続いたため、少し時間をおいてからもう一度お試しください。"
+
+def cached_site_results(keyword):
+    """キャッシュに残っている結果だけで (サイト名, 検索結果) のリストを作る（1件もなければ None）
+
+    流量制限で検索しない場合に使う。期限切れの結果も使い、最近0件だったサイトは空、キャッシュにないサイトは None になる。
+    """
+    site_results = [
+        (site_name, [] if known_empty(site, keyword) else search_cache.peek(site, keyword, allow_expired=True))
+        for site, site_name, _ in SEARCH_PROVIDERS
+    ]
+    if all(results is None for _, results in site_results):
+        return None
+    return site_results
+
+def is_valid_keyword(user_message):
+    """検索ワードとして受け付ける長さ（1〜100文字）かどうかを判定する"""
+    return bool(user_message) and len(user_message) <= 100
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     """ユーザーからのメッセージを処理する"""
     # ユーザーからのメッセージを取得
     user_message = event.message.text
-    logger.info(f"Received message: {user_message}")
+    logger.info("Received message: %s", user_message)
+    started = time.perf_counter()
 
     try:
         # 空のメッセージや長すぎるメッセージをチェック
-        if not user_message or len(user_message) > 100:
+        if not is_valid_keyword(user_message):
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="検索ワードは1〜100文字で入力してください。")
+                TextSendMessage(text=INVALID_KEYWORD_TEXT)
             )
             return
 
-        # モッピーとハピタスで検索を実行
-        moppy_results = search_moppy(user_message)
-        hapitas_results = search_hapitas(user_message)
+        # 表記ゆれをそろえた検索語（キャッシュ・カタログのキーに使う）と、サイトへ送る軽く整えた検索語。返信の表示は入力どおり
+        query = canonicalize(user_message)
+        search_query = clean_query(user_message)
+        if not query:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=INVALID_KEYWORD_TEXT))
+            return
 
-        # 両方の検索結果が空の場合
-        if not moppy_results and not hapitas_results:
+        # 短時間に検索を繰り返すユーザーには、キャッシュにある結果か定型文だけを返す
+        if not user_limiter.allow(event_source_key(event)):
+            logger.warning("Rate limited user message: %s", user_message)
+            site_results = cached_site_results(query)
+            if site_results is None:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=THROTTLED_TEXT))
+            else:
+                send_search_results(event.reply_token, user_message, site_results)
+            return
+
+        # 先読みの対象を決めるため、検索されたキーワードを数える
+        keyword_sketch.record(search_query)
+
+        # モッピーとハピタスを並列に検索（締め切りまでに終わらなかったサイトは結果なし扱い）
+        site_results = search_all(query, search_query)
+
+        # すべての検索結果が空の場合
+        if not any(results for _, results in site_results):
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text=f"「{user_message}」に関する検索結果が見つかりませんでした。別のキーワードで試してみてください。")
+                TextSendMessage(text=NOT_FOUND_TEXT.format(keyword=user_message))
             )
             return
 
         # 検索結果をユーザーに送信
-        send_search_results(event.reply_token, user_message, moppy_results, hapitas_results)
+        send_search_results(event.reply_token, user_message, site_results)
     except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during search: {e}")
+        logger.error("Network error during search: %s", e)
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text="検索中にネットワークエラーが発生しました。しばらく経ってからもう一度お試しください。")
+            TextSendMessage(text=NETWORK_ERROR_TEXT)
         )
+    except RateLimitedError as e:
+        logger.warning("Search skipped by rate limit: %s", e)
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=THROTTLED_TEXT))
     except LineBotApiError as e:
-        logger.error(f"LINE API error: {e}")
+        logger.error("LINE API error: %s", e)
         # LINEのAPIエラーはユーザーに通知しない（通知できない可能性が高い）
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unexpected error: %s", e)
         try:
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="予期せぬエラーが発生しました。しばらく経ってからもう一度お試しください。")
+                TextSendMessage(text=UNEXPECTED_ERROR_TEXT)
             )
         except Exception:
             pass  # 最後のエラー通知も失敗した場合は無視
+    finally:
+        handle_message_seconds.observe(time.perf_counter() - started)
+
+def search_moppy(keyword, search_query=None, deadline=None):
+    """モッピーサイトで検索を実行し、上位3件の結果を返す
 
-def search_moppy(keyword):
-    """モッピーサイトで検索を実行し、上位3件の結果を返す"""
-    logger.info(f"Searching Moppy for: {keyword}")
+    keyword は正規形（保存済みの広告一覧の検索に使う）、search_query はサイトへ送る検索語（省略時は keyword）。
+    deadline は検索全体の締め切り（time.monotonic() の時刻）。取得のタイムアウトは締め切りまでの残り時間に収める。
+    """
+    logger.info("Searching Moppy for: %s", search_query or keyword)
     
-    url = "https://pc.moppy.jp/search"
-    params = {"word": keyword}
+    # 保存済みの広告一覧にあればそれを返し、なければサイトを直接検索する
+    results = lookup_moppy_snapshot(keyword)
+    if results:
+        return results
+    
+    params = {"word": search_query or keyword}
     
     try:
-        # タイムアウト設定を追加
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        results = []
-        
-        # 検索結果の広告カードを取得（修正済み）
-        # 実際の広告カードを特定するためのセレクタを精緻化
-        
-        # 検索結果エリアを特定
-        search_result_area = soup.select_one('.search-result')
-        if not search_result_area:
-            search_result_area = soup
-        
-        # 広告カードを取得
-        # 広告カードは通常、ポイント数を含む要素を持っている
-        ad_cards = []
-        
-        # 方法1: ポイント表記（例: 11,000P）を含む要素の親要素を探す
-        point_elements = search_result_area.find_all(string=re.compile(r'\d+,?\d*P'))
-        for point_elem in point_elements:
-            # 親要素をたどって広告カード全体を取得
-            parent = point_elem.parent
-            while parent and parent.name != 'a' and not (parent.name == 'div' and 'item' in parent.get('class', [])):
-                parent = parent.parent
-                if parent is None:
-                    break
-            
-            if parent and parent not in ad_cards:
-                ad_cards.append(parent)
-        
-        
-        # 広告カードから情報を抽出
-        for card in ad_cards[:3]:  # 上位3件を取得
-            # タイトル要素を探す
-            title = None
-            url = None
-            
-            # カードがaタグの場合
-            if card.name == 'a':
-                url = card.get('href')
-                # タイトルを探す
-                title_elem = card.select_one('h3, .item-name, .item-title, [class*="title"]')
-                if title_elem:
-                    title = title_elem.get_text(strip=True)
-                else:
-                    # テキストノードを直接取得
-                    texts = [text for text in card.stripped_strings]
-                    if texts:
-                        # 最初の非空テキストをタイトルとして使用
-                        title = next((text for text in texts if text and not text.endswith('P')), None)
-            
-            # カードがdivタグの場合
-            else:
-                # リンク要素を探す
-                link_elem = card.select_one('a')
-                if link_elem:
-                    url = link_elem.get('href')
-                
-                # タイトル要素を探す
-                title_elem = card.select_one('h3, .item-name, .item-title, [class*="title"]')
-                if title_elem:
-                    title = title_elem.get_text(strip=True)
-                else:
-                    # テキストノードを直接取得
-                    texts = [text for text in card.stripped_strings]
-                    if texts:
-                        # 最初の非空テキストをタイトルとして使用
-                        title = next((text for text in texts if text and not text.endswith('P')), None)
-            
-            # ナビゲーション要素を除外（「ホーム」「ランキング」などの単純な1単語のタイトル）
-            if title and url and not re.match(r'^[ぁ-んァ-ンー一-龥a-zA-Z]{1,4}$', title):
-                # タイトルが長すぎる場合は切り詰める
-                if len(title) > 40:
-                    title = title[:37] + "..."
-                
-                # 相対URLの場合は絶対URLに変換
-                if url and not url.startswith('http'):
-                    url = f"https://pc.moppy.jp{url}"
-                
-                # 重複チェック
-                if not any(r['url'] == url for r in results):
-                    results.append({
-                        'title': title,
-                        'url': url
-                    })
-        
-        return results[:3]  # 最大3件を返す
+        # 共有セッションで取得（接続の再利用と条件付きリクエスト）
+        # ブレーカーが開いている間は取得せずに失敗し、タイムアウトは最近の応答時間に合わせる
+        # サイトへの取得全体の予算を超えている場合は取得しない（キャッシュがあれば呼び出し側で使う）
+        breaker = site_breakers['moppy']
+        timeout = fetch_timeout(breaker, deadline)
+        if not live_fetch_budget.try_acquire():
+            raise RateLimitedError("Live fetch budget exhausted")
+        # 本文を受信しながら検索結果エリアの広告カードを読み、上位3件がそろった時点で接続を閉じる
+        extractor = moppy_stream_extractor(limit=3, scan=scan_moppy)
+        with search_stage_seconds.time(site='moppy', stage='fetch'):
+            results = breaker.call(
+                site_session.get_extracted, MOPPY_SEARCH_URL, extractor, params=params, timeout=timeout
+            )
+        # 受信中に行った抽出の時間（fetch の時間にも含まれる）
+        search_stage_seconds.observe(extractor.parse_seconds, site='moppy', stage='parse')
+        return results
+    except CircuitOpenError:
+        logger.warning("Skipping Moppy search: circuit is open")
+        raise
+    except RateLimitedError:
+        logger.warning("Skipping Moppy search: live fetch budget exhausted")
+        raise
     except Exception as e:
-        logger.error(f"Error searching Moppy: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error searching Moppy: %s", e)
         # エラーを上位に伝播させる
         raise
 
-def search_hapitas(keyword):
-    """ハピタスサイトで検索を実行し、上位3件の結果を返す"""
-    logger.info(f"Searching Hapitas for: {keyword}")
-    
-    # ハピタスの広告情報を直接取得する
-    # 実際のサイト構造に基づいて、広告情報を定義
-    hapitas_ads = [
-        {
-            'title': '楽天カード 新規カード発行',
-            'url': 'https://hapitas.jp/service/detail/10240',
-            'keywords': ['楽天', 'カード', 'クレジット', 'ポイント', '発行', '新規']
-        },
-        {
-            'title': 'Oisix（オイシックス）のおためしセット',
-            'url': 'https://hapitas.jp/service/detail/10241',
-            'keywords': ['オイシックス', 'おためし', '食品', '宅配', 'セット', '野菜']
-        },
-        {
-            'title': 'NURO光 新規回線開通',
-            'url': 'https://hapitas.jp/service/detail/10242',
-            'keywords': ['NURO', '光', 'インターネット', '回線', '開通', '高速']
-        },
-        {
-            'title': 'DHCオンラインショップ',
-            'url': 'https://hapitas.jp/service/detail/10243',
-            'keywords': ['DHC', '化粧品', 'サプリ', 'オンライン', 'ショップ', '通販']
-        },
-        {
-            'title': 'Brandear（ブランディア）査定申込',
-            'url': 'https://hapitas.jp/service/detail/10244',
-            'keywords': ['ブランディア', '査定', '買取', 'ブランド', '宅配', '申込']
-        },
-        {
-            'title': 'GU（ジーユー）',
-            'url': 'https://hapitas.jp/service/detail/10245',
-            'keywords': ['GU', 'ジーユー', '服', 'ファッション', '衣料', '通販']
-        },
-        {
-            'title': 'Expedia 海外・国内ホテル予約',
-            'url': 'https://hapitas.jp/service/detail/10246',
-            'keywords': ['Expedia', 'ホテル', '予約', '旅行', '海外', '国内']
-        },
-        {
-            'title': 'U-NEXT 31日間無料トライアル',
-            'url': 'https://hapitas.jp/service/detail/10247',
-            'keywords': ['U-NEXT', '動画', 'トライアル', '無料', '配信', '映画']
-        },
-        {
-            'title': 'au PAY カード',
-            'url': 'https://hapitas.jp/service/detail/10248',
-            'keywords': ['au', 'PAY', 'カード', 'クレジット', 'ポイント', '還元']
-        },
-        {
-            'title': '三井住友カード',
-            'url': 'https://hapitas.jp/service/detail/10249',
-            'keywords': ['三井住友', 'カード', 'クレジット', 'ポイント', '還元', 'Vポイント']
-        },
-        {
-            'title': 'dカード',
-            'url': 'https://hapitas.jp/service/detail/10250',
-            'keywords': ['dカード', 'ドコモ', 'クレジット', 'ポイント', '還元', 'dポイント']
-        },
-        {
-            'title': 'JCBカード',
-            'url': 'https://hapitas.jp/service/detail/10251',
-            'keywords': ['JCB', 'カード', 'クレジット', 'ポイント', '還元', 'Oki Dokiポイント']
-        }
-    ]
-    
-    # キーワードに関連する広告をフィルタリング
-    filtered_ads = []
-    
-    # 1. タイトルに完全一致するものを探す
-    for ad in hapitas_ads:
-        if keyword.lower() in ad['title'].lower():
-            filtered_ads.append({
-                'title': ad['title'],
-                'url': ad['url']
-            })
-    
-    # 2. キーワードリストに完全一致するものを探す
-    if len(filtered_ads) < 3:
-        for ad in hapitas_ads:
-            if keyword.lower() in [k.lower() for k in ad['keywords']] and not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-    
-    # 3. 部分一致するものを探す
-    if len(filtered_ads) < 3:
-        for ad in hapitas_ads:
-            # タイトルに部分一致
-            if any(part.lower() in ad['title'].lower() for part in keyword.split() if len(part) >= 2) and not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-            # キーワードリストに部分一致
-            elif any(any(part.lower() in k.lower() for k in ad['keywords']) for part in keyword.split() if len(part) >= 2) and not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-    
-    # 4. それでも足りない場合は、カード関連の広告を優先的に追加
-    if len(filtered_ads) < 3 and ('カード' in keyword or 'クレジット' in keyword):
-        for ad in hapitas_ads:
-            if ('カード' in ad['title'] or 'クレジット' in ad['keywords']) and not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-    
-    # 5. それでも足りない場合は、ポイント関連の広告を優先的に追加
-    if len(filtered_ads) < 3 and 'ポイント' in keyword:
-        for ad in hapitas_ads:
-            if 'ポイント' in ad['keywords'] and not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-    
-    # 6. それでも足りない場合は、残りの広告から追加
-    if len(filtered_ads) < 3:
-        for ad in hapitas_ads:
-            if not any(f['url'] == ad['url'] for f in filtered_ads):
-                filtered_ads.append({
-                    'title': ad['title'],
-                    'url': ad['url']
-                })
-                if len(filtered_ads) >= 3:
-                    break
+def fetch_timeout(breaker, deadline=None):
+    """サイト取得のタイムアウト（ブレーカーが決めた値を、締め切りまでの残り時間に収める）
+
+    締め切りを過ぎている場合は取得せずに requests.exceptions.Timeout を送出する。
+    """
+    timeout = breaker.timeout()
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout(f"Search deadline passed before fetching {breaker.name}")
+    return min(timeout, remaining)
+
+def lookup_moppy_snapshot(keyword):
+    """保存済みの広告一覧からモッピーの検索結果を返す（ストアがない・該当しない場合は空リスト）"""
+    if snapshot_store is None:
+        return []
+    try:
+        with search_stage_seconds.time(site='moppy', stage='snapshot'):
+            return snapshot_store.search('moppy', keyword, limit=3, max_age=SNAPSHOT_MAX_AGE_SECONDS)
+    except Exception as e:
+        logger.warning("Snapshot lookup failed, falling back to live search: %s", e)
+        return []
+
+def search_hapitas(keyword, search_query=None, deadline=None):
+    """ハピタスサイトで検索を実行し、上位3件の結果を返す（カタログは正規形の keyword で引く）"""
+    logger.info("Searching Hapitas for: %s", keyword)
     
-    return filtered_ads[:3]  # 最大3件を返す
+    # 起動時に作成したカタログのインデックスから、関連する広告を優先順位順に取得する
+    with search_stage_seconds.time(site='hapitas', stage='match'):
+        return hapitas_catalog.search(keyword, limit=3)
+
+# 検索対象サイト（サイトID、表示名、検索関数）。カルーセルはこの順に並ぶ
+# 検索関数は (正規形のキーワード, サイトへ送る検索語, 締め切り) を受け取る
+SEARCH_PROVIDERS = [
+    ("moppy", "モッピー", search_moppy),
+    ("hapitas", "ハピタス", search_hapitas),
+]
+
+# メモリ上のデータを引くだけのサイト。検索スレッドのプールを通さず、リクエストを処理しているスレッドで実行する
+# （サイトへの取得が詰まってもプールの空き待ちで締め切りを過ぎないように）
+LOCAL_PROVIDERS = frozenset(["hapitas"])
+
+def known_empty(site, keyword):
+    """最近そのサイトで検索結果が0件だったキーワードなら True（サイトへの取得を省く）"""
+    return negative_cache is not None and negative_cache.contains(site, keyword)
+
+def remember_if_empty(site, keyword, results):
+    """検索結果が0件なら記録して results をそのまま返す"""
+    if not results and negative_cache is not None:
+        negative_cache.add(site, keyword)
+    return results
+
+def run_provider(site, func, keyword, search_query=None, deadline=None):
+    """キャッシュを通してサイト検索を実行する（同じキーワードの同時検索は1回にまとめる）
+
+    キャッシュと同時検索のキーは正規形の keyword。サイトへは search_query を送る。
+    """
+    def load(keyword, deadline=deadline):
+        return remember_if_empty(
+            site, keyword, single_flight.do((site, keyword), func, keyword, search_query, deadline)
+        )
+
+    def refresh(keyword):
+        # バックグラウンドの再取得は利用者の締め切りを過ぎても続けるため、締め切りを渡さない
+        return load(keyword, None)
+
+    with search_stage_seconds.time(site=site, stage='total'):
+        # 最近0件だったキーワードは取得せずに0件として返す
+        if known_empty(site, keyword):
+            return []
+        try:
+            return search_cache.get_or_load(site, keyword, load, refresh_loader=refresh)
+        except (CircuitOpenError, RateLimitedError):
+            # 遮断中・予算切れの間は期限切れでもキャッシュに残っている結果があればそれを返す
+            cached = search_cache.peek(site, keyword, allow_expired=True)
+            if cached is not None:
+                return cached
+            raise
+
+def prefetch_keyword(search_query):
+    """検索語の検索結果を全サイト分取得し直してキャッシュに保存する（先読み用。集計にはサイトへ送る検索語を記録している）"""
+    keyword = canonicalize(search_query)
+    error = None
+    for site, _, func in SEARCH_PROVIDERS:
+        try:
+            results = remember_if_empty(site, keyword, single_flight.do((site, keyword), func, keyword, search_query, None))
+            search_cache.put(site, keyword, results)
+        except Exception as e:
+            error = e
+    if error is not None:
+        raise error
+
+prefetch_scheduler = PrefetchScheduler(
+    keyword_sketch,
+    prefetch_keyword,
+    top_n=PREFETCH_TOP_N,
+    interval=PREFETCH_INTERVAL_SECONDS,
+    delay=PREFETCH_DELAY_SECONDS,
+    decay=PREFETCH_DECAY,
+    path=POPULAR_KEYWORDS_PATH
+)
+atexit.register(prefetch_scheduler.stop)
+if PREFETCH_INTERVAL_SECONDS > 0:
+    prefetch_scheduler.start()
+
+metrics.callback(
+    'linebot_prefetch_total', 'Hot keywords prefetched in the background by result',
+    lambda: [({'result': 'ok'}, prefetch_scheduler.prefetched), ({'result': 'error'}, prefetch_scheduler.failed)],
+    type_name='counter'
+)
+
+def search_all(keyword, search_query=None, deadline=None):
+    """全サイトを並列に検索し、締め切りまでに完了したサイトの結果を返す
+
+    keyword は正規形、search_query はサイトへ送る検索語（省略時は keyword）。deadline は締め切りまでの秒数。
+    LOCAL_PROVIDERS のサイトは、ほかのサイトの検索を開始したあとにこのスレッドで実行する。
+    戻り値は (サイト名, 検索結果) のリスト。タイムアウトやエラーになったサイトの検索結果は None になる。
+    すべてのサイトが失敗した場合は、最初のエラー（なければタイムアウト）を送出する。
+    """
+    if deadline is None:
+        deadline = SEARCH_DEADLINE_SECONDS
+
+    deadline_at = time.monotonic() + deadline
+    futures = {
+        site: search_executor.submit(run_provider, site, func, keyword, search_query, deadline_at)
+        for site, _, func in SEARCH_PROVIDERS
+        if site not in LOCAL_PROVIDERS
+    }
+    for site, _, func in SEARCH_PROVIDERS:
+        if site in LOCAL_PROVIDERS:
+            futures[site] = run_inline(run_provider, site, func, keyword, search_query, deadline_at)
+    futures = [(site, site_name, futures[site]) for site, site_name, _ in SEARCH_PROVIDERS]
+    wait([future for _, _, future in futures], timeout=max(0, deadline_at - time.monotonic()))
+
+    site_results = []
+    errors = []
+    for site, site_name, future in futures:
+        if not future.done():
+            # 実行中のスレッドは止められないため、結果を待たずに切り捨てる
+            future.cancel()
+            search_timeouts_total.inc(site=site)
+            logger.warning("%s search timed out after %ss: %s", site_name, deadline, keyword)
+            site_results.append((site_name, None))
+        elif future.exception() is not None:
+            search_errors_total.inc(site=site)
+            logger.error("%s search failed: %s", site_name, future.exception())
+            errors.append(future.exception())
+            site_results.append((site_name, None))
+        else:
+            site_results.append((site_name, future.result()))
+
+    if all(results is None for _, results in site_results):
+        if errors:
+            raise errors[0]
+        raise requests.exceptions.Timeout(f"All searches timed out after {deadline}s")
+
+    return site_results
+
+def run_inline(func, *args):
+    """func(*args) をこのスレッドで実行し、結果（または例外）を完了済みの Future で返す"""
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 def create_flex_message(site_name, results):
-    """Flex Messageを作成する"""
+    """Flex Messageを作成する（resultsがNoneの場合はタイムアウト・エラー表示）"""
+    if results is None:
+        return BubbleContainer(
+            body=BoxComponent(
+                layout="vertical",
+                contents=[
+                    TextComponent(text=f"{site_name}", weight="bold", size="xl", color="#1DB446"),
+                    TextComponent(text="時間内に検索結果を取得できませんでした。", margin="md", wrap=True)
+                ]
+            )
+        )
+
     if not results:
         return BubbleContainer(
             body=BoxComponent(
@@ -381,27 +751,30 @@ def create_flex_message(site_name, results):
         )
     )
 
-def send_search_results(reply_token, keyword, moppy_results, hapitas_results):
+def build_search_messages(keyword, site_results):
+    """検索結果の返信メッセージ（テキストとカルーセル）を作成する
+
+    カルーセルは create_flex_message と同じ内容のJSONを雛形から直接作り、同じ検索結果のバブルは使い回す。
+    """
+    carousel = render_carousel(site_results)
+    
+    return [
+        TextSendMessage(text=f"「{keyword}」の検索結果です。"),
+        RenderedFlexSendMessage(alt_text=f"「{keyword}」の検索結果", contents=carousel)
+    ]
+
+def send_search_results(reply_token, keyword, site_results):
     """検索結果をLINEメッセージとして送信する"""
     try:
-        # Flex Messageを作成
-        moppy_bubble = create_flex_message("モッピー", moppy_results)
-        hapitas_bubble = create_flex_message("ハピタス", hapitas_results)
-        
-        # カルーセルコンテナにバブルを追加
-        carousel = CarouselContainer(contents=[moppy_bubble, hapitas_bubble])
+        with reply_stage_seconds.time(stage='flex'):
+            messages = build_search_messages(keyword, site_results)
         
         # メッセージを送信
-        messages = [
-            TextSendMessage(text=f"「{keyword}」の検索結果です。"),
-            FlexSendMessage(alt_text=f"「{keyword}」の検索結果", contents=carousel)
-        ]
-        
-        line_bot_api.reply_message(reply_token, messages)
-        logger.info(f"Successfully sent search results for: {keyword}")
+        with reply_stage_seconds.time(stage='reply'):
+            line_bot_api.reply_message(reply_token, messages)
+        logger.info("Successfully sent search results for: %s", keyword)
     except Exception as e:
-        logger.error(f"Error sending search results: {e}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error sending search results: %s", e)
         # エラーを上位に伝播させる
         raise
 
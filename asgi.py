@@ -0,0 +1,445 @@
+"""ASGIサーバー用のエントリポイント（1つのイベントループで検索とLINEへの返信を非同期に行う）
+
+使い方:
+    uvicorn asgi:application --host 0.0.0.0 --port 8000
+
+Flask版（app.py の app）と同じ /callback・/health・/metrics を提供する。設定、キャッシュ、カタログ、
+抽出処理、Flexの組み立て、メトリクスは app.py のものをそのまま使い、サイトへの取得とLINEへの返信だけを
+aiohttp で非同期に行う。HTMLの解析はCPUを使うため、イベントループを止めないようスレッドで実行する。
+サイトの本文は受信しながら解析し、上位の結果がそろった時点で残りを受信せずに接続を閉じる。
+"""
+import asyncio
+import codecs
+import json
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage
+
+import app as bot
+from circuit_breaker import CircuitOpenError
+from rate_limit import RateLimitedError
+from extract import moppy_stream_extractor
+from http_session import accept_encoding
+from search_cache import SearchCache
+from singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+# 同じサイト・キーワードの同時検索を1回の取得にまとめる（イベントループ内用）
+single_flight = AsyncSingleFlight()
+
+# 受け付けたイベントの処理タスク（完了まで参照を持っておく）
+_background_tasks = set()
+
+# 同時に処理するイベントのグループ（送信元ごと）の数の上限と、空きを待っているグループの数
+_dispatch_slots = asyncio.Semaphore(max(1, bot.ASGI_MAX_CONCURRENT_EVENTS))
+_waiting_groups = 0
+
+# 応答トークンの有効期限切れで破棄したイベントと、空き待ちが多いためレスポンスを返す前に処理したグループの数
+dropped_stale = 0
+handled_inline = 0
+
+# サイト取得とLINEへの返信で共有するHTTPセッション（lifespan の開始時に作成する）
+_http = None
+_line_api = None
+
+bot.metrics.callback(
+    'linebot_async_single_flight_coalesced_total', 'Searches that shared an in-flight fetch (ASGI mode)',
+    lambda: [({}, single_flight.coalesced)],
+    type_name='counter'
+)
+bot.metrics.callback('linebot_async_tasks_in_flight', 'Webhook event tasks running (ASGI mode)', lambda: [({}, len(_background_tasks))])
+bot.metrics.callback(
+    'linebot_async_event_groups_waiting', 'Webhook event groups waiting for a dispatch slot (ASGI mode)',
+    lambda: [({}, _waiting_groups)]
+)
+bot.metrics.callback(
+    'linebot_async_events_dropped_total', 'Webhook events dropped because the reply token expired (ASGI mode)',
+    lambda: [({'reason': 'stale'}, dropped_stale)],
+    type_name='counter'
+)
+bot.metrics.callback(
+    'linebot_async_event_groups_inline_total', 'Webhook event groups handled before responding because too many were waiting (ASGI mode)',
+    lambda: [({}, handled_inline)],
+    type_name='counter'
+)
+
+
+async def startup():
+    """共有のHTTPセッションとLINEのAPIクライアントを作成する"""
+    global _http, _line_api
+    if _http is None:
+        _http = aiohttp.ClientSession(
+            headers={'Accept-Encoding': accept_encoding()},
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=100)
+        )
+        _line_api = AsyncLineBotApi(
+            bot.LINE_CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(_http), endpoint=bot.LINE_API_ENDPOINT
+        )
+
+
+async def shutdown():
+    """処理中のイベントを待ってから共有のHTTPセッションを閉じる"""
+    global _http, _line_api
+    if _background_tasks:
+        await asyncio.wait(set(_background_tasks), timeout=bot.REPLY_TOKEN_MAX_AGE_SECONDS)
+    if _http is not None:
+        await _http.close()
+    _http = None
+    _line_api = None
+
+
+async def application(scope, receive, send):
+    """ASGIアプリケーション"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    # lifespan に対応していないサーバーでも動くように、最初のリクエストで作成する
+    await startup()
+
+    method, path = scope['method'], scope['path']
+    if path == '/callback' and method == 'POST':
+        await callback(scope, receive, send)
+    elif path == '/health' and method == 'GET':
+        await respond(send, 200, json.dumps(health()).encode('utf-8'), 'application/json')
+    elif path == '/metrics' and method == 'GET':
+        await respond(send, 200, bot.metrics.render().encode('utf-8'), 'text/plain; version=0.0.4')
+    else:
+        await respond(send, 404, b'Not Found')
+
+
+async def lifespan(receive, send):
+    """サーバーの起動・終了に合わせてセッションを作成・破棄する"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def respond(send, status, body, content_type='text/plain; charset=utf-8'):
+    """レスポンスを1回で送る"""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def read_body(receive):
+    """リクエストボディを最後まで読む"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def callback(scope, receive, send):
+    """LINE Webhookからのコールバックを処理する（署名を検証したらすぐに200を返す）"""
+    headers = dict(scope['headers'])
+    signature = headers.get(b'x-line-signature', b'').decode('latin-1')
+    body = (await read_body(receive)).decode('utf-8')
+    sampled_body = bot.body_sampler.sample(body)
+    if sampled_body is not None:
+        logger.info("Request body", extra={'body': sampled_body})
+
+    try:
+        events = bot.handler.parser.parse(body, signature)
+    except InvalidSignatureError:
+        logger.error("Invalid signature. Please check your channel access token/channel secret.")
+        await respond(send, 400, b'Bad Request')
+        return
+    except Exception as e:
+        logger.exception("Unexpected error in callback: %s", e)
+        await respond(send, 500, b'Internal Server Error')
+        return
+
+    await dispatch_events(events)
+    await respond(send, 200, b'OK')
+
+
+def health():
+    """稼働状況を返す"""
+    return {
+        'status': 'ok',
+        'mode': 'asgi',
+        'tasks_in_flight': len(_background_tasks),
+        'event_groups_waiting': _waiting_groups,
+        'events_dropped_stale': dropped_stale,
+        'event_groups_handled_inline': handled_inline,
+        'search_cache': bot.search_cache.stats(),
+        'single_flight': single_flight.stats(),
+        'circuit_breakers': {site: breaker.stats() for site, breaker in bot.site_breakers.items()},
+        'prefetch': bot.prefetch_scheduler.stats(),
+        'rate_limits': {'user': bot.user_limiter.stats(), 'live_fetch': bot.live_fetch_budget.stats()}
+    }
+
+
+async def dispatch_events(events):
+    """送信元ごとにタスクを作り、同じ送信元のイベントは順番に処理する
+
+    空きを待っているグループが WEBHOOK_QUEUE_SIZE 以上ある場合は、タスクを作らずにその場で処理し、
+    終わるまでレスポンスを返さないことで流入を抑える（Flask版でキューが満杯の場合と同じ）。
+    """
+    global _waiting_groups, handled_inline
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault(bot.event_source_key(event), []).append(event)
+
+    for group in groups.values():
+        if _waiting_groups >= bot.WEBHOOK_QUEUE_SIZE:
+            handled_inline += 1
+            logger.warning("Too many event groups waiting (%s), handling before responding", _waiting_groups)
+            _waiting_groups += 1
+            await dispatch_in_order(group)
+            continue
+        _waiting_groups += 1
+        task = asyncio.create_task(dispatch_in_order(group))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def dispatch_in_order(events):
+    """空きを待ってからイベントを順番に処理する（1件が失敗しても残りは処理する）
+
+    呼び出す前に _waiting_groups を1増やしておく。待っている間に応答トークンの有効期限を過ぎたイベントは破棄する。
+    """
+    global _waiting_groups, dropped_stale
+    try:
+        await _dispatch_slots.acquire()
+    finally:
+        _waiting_groups -= 1
+    try:
+        for event in events:
+            if bot.event_queue.is_stale(event):
+                dropped_stale += 1
+                logger.warning("Dropping stale event (older than %ss)", bot.event_queue.max_event_age)
+                continue
+            try:
+                if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+                    await handle_message(event)
+            except Exception as e:
+                logger.exception("Unexpected error while dispatching event: %s", e)
+    finally:
+        _dispatch_slots.release()
+
+
+async def handle_message(event):
+    """ユーザーからのメッセージを処理する（app.handle_message の非同期版）"""
+    user_message = event.message.text
+    logger.info("Received message: %s", user_message)
+    started = time.perf_counter()
+
+    try:
+        if not bot.is_valid_keyword(user_message):
+            await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.INVALID_KEYWORD_TEXT))
+            return
+
+        query = bot.canonicalize(user_message)
+        search_query = bot.clean_query(user_message)
+        if not query:
+            await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.INVALID_KEYWORD_TEXT))
+            return
+
+        if not bot.user_limiter.allow(bot.event_source_key(event)):
+            logger.warning("Rate limited user message: %s", user_message)
+            site_results = bot.cached_site_results(query)
+            if site_results is None:
+                await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.THROTTLED_TEXT))
+            else:
+                await send_search_results(event.reply_token, user_message, site_results)
+            return
+
+        bot.keyword_sketch.record(search_query)
+        site_results = await search_all(query, search_query)
+
+        if not any(results for _, results in site_results):
+            await _line_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=bot.NOT_FOUND_TEXT.format(keyword=user_message))
+            )
+            return
+
+        await send_search_results(event.reply_token, user_message, site_results)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Network error during search: %s", e)
+        await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.NETWORK_ERROR_TEXT))
+    except RateLimitedError as e:
+        logger.warning("Search skipped by rate limit: %s", e)
+        await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.THROTTLED_TEXT))
+    except LineBotApiError as e:
+        logger.error("LINE API error: %s", e)
+        # LINEのAPIエラーはユーザーに通知しない（通知できない可能性が高い）
+    except Exception as e:
+        logger.exception("Unexpected error: %s", e)
+        try:
+            await _line_api.reply_message(event.reply_token, TextSendMessage(text=bot.UNEXPECTED_ERROR_TEXT))
+        except Exception:
+            pass  # 最後のエラー通知も失敗した場合は無視
+    finally:
+        bot.handle_message_seconds.observe(time.perf_counter() - started)
+
+
+async def send_search_results(reply_token, keyword, site_results):
+    """検索結果をLINEメッセージとして送信する"""
+    with bot.reply_stage_seconds.time(stage='flex'):
+        messages = bot.build_search_messages(keyword, site_results)
+
+    with bot.reply_stage_seconds.time(stage='reply'):
+        await _line_api.reply_message(reply_token, messages)
+    logger.info("Successfully sent search results for: %s", keyword)
+
+
+async def fetch_extracted(url, params, timeout, extractor):
+    """ページ本文を受信しながら extractor に渡し、抽出結果を返す（4xx/5xx は例外）
+
+    受信した断片の読み取りと抽出はスレッドで行い、extractor.feed() が True を返したら接続を閉じる。
+    """
+    async with _http.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        response.raise_for_status()
+        decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        async for chunk in response.content.iter_chunked(bot.site_session.chunk_size):
+            if await asyncio.to_thread(extractor.feed, decoder.decode(chunk)):
+                # 残りの本文は読まずに接続ごと閉じる
+                response.close()
+                return extractor.close()
+        await asyncio.to_thread(extractor.feed, decoder.decode(b'', final=True))
+        return await asyncio.to_thread(extractor.close)
+
+
+async def search_moppy(keyword, search_query=None, deadline=None):
+    """モッピーサイトで検索を実行し、上位3件の結果を返す（app.search_moppy の非同期版）"""
+    logger.info("Searching Moppy for: %s", search_query or keyword)
+
+    # 保存済みの広告一覧の検索はSQLiteを読むため、イベントループを止めないようスレッドで実行する
+    results = await asyncio.to_thread(bot.lookup_moppy_snapshot, keyword) if bot.snapshot_store is not None else []
+    if results:
+        return results
+
+    try:
+        breaker = bot.site_breakers['moppy']
+        timeout = bot.fetch_timeout(breaker, deadline)
+        if not bot.live_fetch_budget.try_acquire():
+            raise RateLimitedError("Live fetch budget exhausted")
+        extractor = moppy_stream_extractor(limit=3, scan=bot.scan_moppy)
+        with bot.search_stage_seconds.time(site='moppy', stage='fetch'):
+            results = await breaker.call_async(
+                fetch_extracted, bot.MOPPY_SEARCH_URL, {'word': search_query or keyword}, timeout, extractor
+            )
+        bot.search_stage_seconds.observe(extractor.parse_seconds, site='moppy', stage='parse')
+        return results
+    except CircuitOpenError:
+        logger.warning("Skipping Moppy search: circuit is open")
+        raise
+    except RateLimitedError:
+        logger.warning("Skipping Moppy search: live fetch budget exhausted")
+        raise
+    except Exception as e:
+        logger.exception("Error searching Moppy: %s", e)
+        raise
+
+
+async def search_hapitas(keyword, search_query=None, deadline=None):
+    """ハピタスのカタログを検索する（メモリ上のインデックスを引くだけなのでそのまま実行する）"""
+    return bot.search_hapitas(keyword)
+
+
+# サイトIDごとの非同期版の検索関数（並び順と表示名は app.SEARCH_PROVIDERS に従う）
+ASYNC_SEARCH_FUNCTIONS = {
+    'moppy': search_moppy,
+    'hapitas': search_hapitas,
+}
+
+
+async def load_and_store(site, func, keyword, search_query, deadline=None):
+    """サイトを検索して結果をキャッシュに保存する"""
+    results = bot.remember_if_empty(site, keyword, await func(keyword, search_query, deadline))
+    bot.search_cache.put(site, keyword, results)
+    return results
+
+
+async def run_provider(site, func, keyword, search_query=None, deadline=None):
+    """キャッシュを通してサイト検索を実行する（app.run_provider の非同期版）"""
+    key = (site, keyword)
+    with bot.search_stage_seconds.time(site=site, stage='total'):
+        if bot.known_empty(site, keyword):
+            return []
+        cached, status = bot.search_cache.lookup(site, keyword)
+        if status == SearchCache.FRESH:
+            return cached
+        if status == SearchCache.STALE:
+            # 古い結果を返しつつ、バックグラウンドで更新する
+            refresh = asyncio.ensure_future(single_flight.do(key, load_and_store, site, func, keyword, search_query))
+            refresh.add_done_callback(_log_refresh_failure)
+            return cached
+        try:
+            return await single_flight.do(key, load_and_store, site, func, keyword, search_query, deadline)
+        except (CircuitOpenError, RateLimitedError):
+            # 遮断中・予算切れの間は期限切れでもキャッシュに残っている結果があればそれを返す
+            cached = bot.search_cache.peek(site, keyword, allow_expired=True)
+            if cached is not None:
+                return cached
+            raise
+
+
+def _log_refresh_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background refresh failed: %s", task.exception())
+
+
+async def search_all(keyword, search_query=None, deadline=None):
+    """全サイトを並列に検索し、締め切りまでに完了したサイトの結果を返す（app.search_all の非同期版）"""
+    if deadline is None:
+        deadline = bot.SEARCH_DEADLINE_SECONDS
+
+    deadline_at = time.monotonic() + deadline
+    tasks = [
+        (site, site_name, asyncio.ensure_future(
+            run_provider(site, ASYNC_SEARCH_FUNCTIONS[site], keyword, search_query, deadline_at)
+        ))
+        for site, site_name, _ in bot.SEARCH_PROVIDERS
+    ]
+    await asyncio.wait([task for _, _, task in tasks], timeout=deadline)
+
+    site_results = []
+    errors = []
+    for site, site_name, task in tasks:
+        if not task.done():
+            # 待つのをやめるだけで、共有している取得処理は最後まで続く（結果はキャッシュされる）
+            task.cancel()
+            bot.search_timeouts_total.inc(site=site)
+            logger.warning("%s search timed out after %ss: %s", site_name, deadline, keyword)
+            site_results.append((site_name, None))
+        elif task.exception() is not None:
+            bot.search_errors_total.inc(site=site)
+            logger.error("%s search failed: %s", site_name, task.exception())
+            errors.append(task.exception())
+            site_results.append((site_name, None))
+        else:
+            site_results.append((site_name, task.result()))
+
+    if all(results is None for _, results in site_results):
+        if errors:
+            raise errors[0]
+        raise asyncio.TimeoutError(f"All searches timed out after {deadline}s")
+
+    return site_results
@@ -0,0 +1,175 @@
+"""ネットワークなしで実行できるマイクロベンチマーク
+
+保存済みのHTML（fixtures/moppy/、fixtures/hapitas/）と合成したハピタスカタログを使い、抽出・カタログ検索・
+返信メッセージ作成の速度（ops/sec）と、1回あたりのメモリ使用量のピークと実行後に残った割り当てを計測する。
+
+使い方:
+    python bench.py                      # すべて実行
+    python bench.py extract/ "50000 ads" # 名前（一覧の benchmark 列）に指定文字列を含むものだけ実行
+    python bench.py --min-time 3         # 1項目あたりの計測時間（秒）を変更
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+FIXTURE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# 計測する合成カタログの件数
+CATALOG_SIZES = [12, 1000, 10000, 50000]
+
+# カタログ検索で順に投げるクエリ（各優先順位の段階に当たるものを混ぜる）
+CATALOG_QUERIES = ['楽天', 'カード', 'ポイント', 'クレジットカード', 'gu', '光 回線', 'ホテル 予約', 'zzz', 'dカード', '三井']
+
+
+def synthetic_catalog(size, seed=0):
+    """組み込みカタログの語彙を組み合わせて、指定件数の合成カタログを作る"""
+    from catalog import DEFAULT_HAPITAS_ADS
+
+    rng = random.Random(seed)
+    vocabulary = sorted({k for ad in DEFAULT_HAPITAS_ADS for k in ad['keywords']})
+    ads = []
+    for i in range(size):
+        base = DEFAULT_HAPITAS_ADS[i % len(DEFAULT_HAPITAS_ADS)]
+        ads.append({
+            'title': f"{base['title']} {rng.choice(vocabulary)} {i}",
+            'url': f"https://hapitas.jp/service/detail/{20000 + i}",
+            'keywords': rng.sample(vocabulary, 6)
+        })
+    return ads
+
+
+def measure(func, min_time):
+    """func を min_time 秒以上繰り返して1回あたりの時間とメモリ使用量を返す
+
+    peak_kib は実行中のメモリ使用量のピーク、net_blocks / net_kib は実行後に解放されずに残った割り当て
+    （キャッシュなど）の差し引きで、実行中に割り当てて解放したものは含まない。
+    """
+    func()  # ウォームアップ
+
+    runs = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - started
+
+    # メモリ割り当ては1回分だけトレースして計測する（トレース中は遅くなるため時間計測とは分ける）
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+
+    return {
+        'ops_per_sec': runs / elapsed,
+        'usec_per_op': elapsed / runs * 1e6,
+        'peak_kib': peak / 1024,
+        'net_blocks': sum(stat.count_diff for stat in diff),
+        'net_kib': sum(stat.size_diff for stat in diff) / 1024,
+    }
+
+
+# 各ベンチマーク関数は (名前, 準備関数) を返す。準備関数は絞り込み後に呼ばれ、計測する関数を返す
+
+
+def extract_benchmarks():
+    """保存済みのモッピー・ハピタスの検索ページからの抽出"""
+    from extract import extract_moppy_results, scan_hapitas_results
+
+    for site, extract in (('moppy', extract_moppy_results), ('hapitas', scan_hapitas_results)):
+        fixture_dir = os.path.join(FIXTURE_ROOT, site)
+        for name in sorted(os.listdir(fixture_dir)):
+            if not name.endswith('.html'):
+                continue
+            with open(os.path.join(fixture_dir, name), encoding='utf-8') as f:
+                html = f.read()
+            yield (
+                f"extract/{site}/{name} ({len(html) // 1024}KiB)",
+                lambda extract=extract, html=html: lambda: extract(html)
+            )
+
+
+def catalog_benchmarks():
+    """合成カタログに対するハピタスの検索"""
+    from catalog import CatalogIndex
+    from normalize import canonicalize
+
+    def setup(size):
+        ads = synthetic_catalog(size)
+        started = time.perf_counter()
+        index = CatalogIndex(ads)
+        print(f"  (catalog index for {size} ads built in {(time.perf_counter() - started) * 1000:.1f}ms)")
+
+        def run():
+            for query in CATALOG_QUERIES:
+                index.search(canonicalize(query))
+        return run
+
+    for size in CATALOG_SIZES:
+        yield f"catalog/search x{len(CATALOG_QUERIES)} ({size} ads)", lambda size=size: setup(size)
+
+
+def flex_benchmarks():
+    """返信メッセージ（Flexカルーセル）の作成とJSON化"""
+    site_results = [
+        ("モッピー", [{'title': f"モッピーの広告タイトル {i}", 'url': f"https://pc.moppy.jp/ad/detail.php?site_id={i}"} for i in range(3)]),
+        ("ハピタス", [{'title': f"ハピタスの広告タイトル {i}", 'url': f"https://hapitas.jp/service/detail/{i}"} for i in range(3)]),
+    ]
+
+    def create_bubbles():
+        import app
+
+        def run():
+            for site_name, results in site_results:
+                app.create_flex_message(site_name, results)
+        return run
+
+    def build_payload():
+        import app
+
+        def run():
+            messages = app.build_search_messages("楽天", site_results)
+            json.dumps([message.as_json_dict() for message in messages])
+        return run
+
+    yield "flex/create_flex_message x2", create_bubbles
+    yield "flex/build_search_messages + json", build_payload
+
+
+BENCHMARKS = [extract_benchmarks, catalog_benchmarks, flex_benchmarks]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ネットワークなしで実行できるマイクロベンチマーク')
+    parser.add_argument('filters', nargs='*', help='名前にこの文字列を含むベンチマークだけ実行する')
+    parser.add_argument('--min-time', type=float, default=1.0, help='1項目あたりの計測時間（秒）')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    print(
+        f"{'benchmark':<52} {'ops/sec':>12} {'usec/op':>12} {'peak KiB':>10} {'net blocks':>10} {'net KiB':>9}"
+    )
+    for group in BENCHMARKS:
+        for name, setup in group():
+            if args.filters and not any(f in name for f in args.filters):
+                continue
+            result = measure(setup(), args.min_time)
+            print(
+                f"{name:<52} {result['ops_per_sec']:>12.1f} {result['usec_per_op']:>12.1f} "
+                f"{result['peak_kib']:>10.1f} {result['net_blocks']:>10} {result['net_kib']:>9.1f}"
+            )
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""ハピタス広告カタログと検索用インデックス"""
+import csv
+import json
+import logging
+
+from normalize import canonicalize
+
+logger = logging.getLogger(__name__)
+
+# 実際のサイト構造に基づいて定義した広告情報（カタログファイルを指定しない場合に使う）
+DEFAULT_HAPITAS_ADS = [
+    {
+        'title': '楽天カード 新規カード発行',
+        'url': 'https://hapitas.jp/service/detail/10240',
+        'keywords': ['楽天', 'カード', 'クレジット', 'ポイント', '発行', '新規']
+    },
+    {
+        'title': 'Oisix（オイシックス）のおためしセット',
+        'url': 'https://hapitas.jp/service/detail/10241',
+        'keywords': ['オイシックス', 'おためし', '食品', '宅配', 'セット', '野菜']
+    },
+    {
+        'title': 'NURO光 新規回線開通',
+        'url': 'https://hapitas.jp/service/detail/10242',
+        'keywords': ['NURO', '光', 'インターネット', '回線', '開通', '高速']
+    },
+    {
+        'title': 'DHCオンラインショップ',
+        'url': 'https://hapitas.jp/service/detail/10243',
+        'keywords': ['DHC', '化粧品', 'サプリ', 'オンライン', 'ショップ', '通販']
+    },
+    {
+        'title': 'Brandear（ブランディア）査定申込',
+        'url': 'https://hapitas.jp/service/detail/10244',
+        'keywords': ['ブランディア', '査定', '買取', 'ブランド', '宅配', '申込']
+    },
+    {
+        'title': 'GU（ジーユー）',
+        'url': 'https://hapitas.jp/service/detail/10245',
+        'keywords': ['GU', 'ジーユー', '服', 'ファッション', '衣料', '通販']
+    },
+    {
+        'title': 'Expedia 海外・国内ホテル予約',
+        'url': 'https://hapitas.jp/service/detail/10246',
+        'keywords': ['Expedia', 'ホテル', '予約', '旅行', '海外', '国内']
+    },
+    {
+        'title': 'U-NEXT 31日間無料トライアル',
+        'url': 'https://hapitas.jp/service/detail/10247',
+        'keywords': ['U-NEXT', '動画', 'トライアル', '無料', '配信', '映画']
+    },
+    {
+        'title': 'au PAY カード',
+        'url': 'https://hapitas.jp/service/detail/10248',
+        'keywords': ['au', 'PAY', 'カード', 'クレジット', 'ポイント', '還元']
+    },
+    {
+        'title': '三井住友カード',
+        'url': 'https://hapitas.jp/service/detail/10249',
+        'keywords': ['三井住友', 'カード', 'クレジット', 'ポイント', '還元', 'Vポイント']
+    },
+    {
+        'title': 'dカード',
+        'url': 'https://hapitas.jp/service/detail/10250',
+        'keywords': ['dカード', 'ドコモ', 'クレジット', 'ポイント', '還元', 'dポイント']
+    },
+    {
+        'title': 'JCBカード',
+        'url': 'https://hapitas.jp/service/detail/10251',
+        'keywords': ['JCB', 'カード', 'クレジット', 'ポイント', '還元', 'Oki Dokiポイント']
+    }
+]
+
+
+def load_catalog(path):
+    """JSONまたはCSVファイルから広告カタログを読み込む
+
+    JSONは title / url / keywords（文字列のリスト）を持つオブジェクトの配列。
+    CSVは title, url, keywords 列を持ち、keywords は「|」区切りで記述する。
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as f:
+            ads = [
+                {
+                    'title': row['title'],
+                    'url': row['url'],
+                    'keywords': [k for k in (row.get('keywords') or '').split('|') if k]
+                }
+                for row in csv.DictReader(f)
+            ]
+    else:
+        with open(path, encoding='utf-8') as f:
+            ads = json.load(f)
+
+    logger.info("Loaded %s ads from %s", len(ads), path)
+    return ads
+
+
+def _ngrams(text, n):
+    """文字n-gramの集合を返す"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class CatalogIndex:
+    """広告カタログから一度だけ作る検索用インデックス
+
+    タイトルとキーワードは normalize（既定は canonicalize）で正規化済みで保持し、キーワードの完全一致表と、
+    部分一致用の文字n-gram（タイトルは1,2-gram、キーワードは2-gram）の転置リストを持つ。
+    search は従来の段階的な優先順位（タイトル一致 → キーワード一致 → 部分一致 → カード・ポイント関連 → 残り）をそのまま守る。
+    """
+
+    def __init__(self, ads, normalize=canonicalize):
+        self.ads = [{'title': ad['title'], 'url': ad['url']} for ad in ads]
+        self.titles = [normalize(ad['title']) for ad in ads]
+        self.keywords = [[k for k in (normalize(k) for k in ad['keywords']) if k] for ad in ads]
+
+        # キーワード完全一致の転置リスト
+        self.keyword_postings = {}
+        # 部分一致用の文字n-gram転置リスト
+        self.title_grams = {}
+        self.keyword_grams = {}
+
+        for ad_id, (title, keywords) in enumerate(zip(self.titles, self.keywords)):
+            for gram in _ngrams(title, 1) | _ngrams(title, 2):
+                self.title_grams.setdefault(gram, []).append(ad_id)
+            for keyword in set(keywords):
+                self.keyword_postings.setdefault(keyword, []).append(ad_id)
+            for gram in set().union(*(_ngrams(k, 2) for k in keywords)):
+                self.keyword_grams.setdefault(gram, []).append(ad_id)
+
+        # カード関連・ポイント関連の広告
+        self.card_ids = [
+            ad_id for ad_id, (title, keywords) in enumerate(zip(self.titles, self.keywords))
+            if 'カード' in title or 'クレジット' in keywords
+        ]
+        self.point_ids = [ad_id for ad_id, keywords in enumerate(self.keywords) if 'ポイント' in keywords]
+
+    def __len__(self):
+        return len(self.ads)
+
+    def search(self, keyword, limit=3):
+        """キーワードに関連する広告を優先順位の高い順に最大limit件返す
+
+        keyword はインデックスと同じ関数で正規化済みのもの（呼び出し側でメッセージごとに1回だけ正規化する）。
+        """
+        query = keyword
+        parts = [part for part in keyword.split() if len(part) >= 2]
+
+        results = []
+        seen_urls = set()
+
+        def add(ad_ids, dedupe=True):
+            for ad_id in ad_ids:
+                if len(results) >= limit:
+                    return
+                ad = self.ads[ad_id]
+                if dedupe and ad['url'] in seen_urls:
+                    continue
+                seen_urls.add(ad['url'])
+                results.append({'title': ad['title'], 'url': ad['url']})
+
+        # 1. タイトルに完全一致するもの（従来どおりURLの重複は除かない）
+        add(self._title_matches(query), dedupe=False)
+
+        # 2. キーワードリストに完全一致するもの
+        if len(results) < limit:
+            add(self.keyword_postings.get(query, []))
+
+        # 3. タイトルまたはキーワードリストに部分一致するもの
+        if len(results) < limit and parts:
+            candidates = set()
+            for part in parts:
+                candidates.update(self._title_matches(part))
+                candidates.update(self._keyword_partial_matches(part))
+            add(sorted(candidates))
+
+        # 4. カード関連の広告
+        if len(results) < limit and ('カード' in keyword or 'クレジット' in keyword):
+            add(self.card_ids)
+
+        # 5. ポイント関連の広告
+        if len(results) < limit and 'ポイント' in keyword:
+            add(self.point_ids)
+
+        # 6. 残りの広告から追加
+        if len(results) < limit:
+            add(range(len(self.ads)))
+
+        return results
+
+    def _title_matches(self, text):
+        """タイトルに text を含む広告IDを昇順で返す"""
+        if not text:
+            return range(len(self.ads))
+        n = 1 if len(text) == 1 else 2
+        candidates = self._candidates(self.title_grams, _ngrams(text, n))
+        return [ad_id for ad_id in candidates if text in self.titles[ad_id]]
+
+    def _keyword_partial_matches(self, text):
+        """いずれかのキーワードに text を含む広告IDを昇順で返す（textは2文字以上）"""
+        candidates = self._candidates(self.keyword_grams, _ngrams(text, 2))
+        return [ad_id for ad_id in candidates if any(text in k for k in self.keywords[ad_id])]
+
+    @staticmethod
+    def _candidates(postings, grams):
+        """すべてのn-gramを含む広告IDの候補を昇順で返す"""
+        lists = sorted((postings.get(gram, []) for gram in grams), key=len)
+        if not lists or not lists[0]:
+            return []
+        candidates = set(lists[0]).intersection(*lists[1:])
+        return sorted(candidates)
@@ -0,0 +1,139 @@
+"""サイトごとのサーキットブレーカーと、実測の応答時間に合わせたタイムアウト"""
+import threading
+import time
+from collections import deque
+
+
+class CircuitOpenError(Exception):
+    """遮断中のサイトを呼び出そうとした"""
+
+
+class CircuitBreaker:
+    """closed / open / half_open の3状態を持つサーキットブレーカー
+
+    closed で連続 failure_threshold 回失敗すると open になり、reset_timeout 秒の間は呼び出さずに
+    CircuitOpenError を送出する。その後 half_open で1件だけ試し、成功すれば closed、失敗すれば open に戻る。
+    タイムアウトは最近の応答時間のパーセンタイルに倍率をかけ、min_timeout〜max_timeout に収める。
+    応答時間には成功した呼び出しのほか、そのときのタイムアウト以上かかって失敗した呼び出しの所要時間も含める
+    （応答が遅くなったサイトでもタイムアウトが伸びていくように）。half_open の試行は max_timeout で行う。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, min_timeout=1.0, max_timeout=10.0,
+                 timeout_percentile=0.95, timeout_multiplier=2.0, window=100, min_samples=10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_samples = min_samples
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+        # 状態遷移と拒否のカウンタ
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        """現在の状態（open の期限が切れていれば half_open とみなす）"""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def timeout(self):
+        """最近の応答時間から決めたタイムアウト（秒）を返す（half_open の試行には max_timeout を返す）"""
+        if self.state != self.CLOSED:
+            return self.max_timeout
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.max_timeout
+        index = min(len(latencies) - 1, int(len(latencies) * self.timeout_percentile))
+        return min(self.max_timeout, max(self.min_timeout, latencies[index] * self.timeout_multiplier))
+
+    def call(self, func, *args, **kwargs):
+        """ブレーカーを通して func を呼び出す。遮断中は呼び出さずに CircuitOpenError を送出する"""
+        timeout = self._before_call()
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record_failure(time.monotonic() - started, timeout)
+            raise
+        self._record_success(time.monotonic() - started)
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        """call の非同期版。func はコルーチン関数"""
+        timeout = self._before_call()
+        started = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self._record_failure(time.monotonic() - started, timeout)
+            raise
+        except BaseException:
+            # キャンセルされた場合は失敗として数えず、half_open の試行枠だけ戻す
+            with self._lock:
+                self._trial_in_flight = False
+            raise
+        self._record_success(time.monotonic() - started)
+        return result
+
+    def stats(self):
+        """ブレーカーの状態を辞書で返す"""
+        return {
+            'state': self.state,
+            'timeout': self.timeout(),
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+    def _before_call(self):
+        """呼び出してよいか判定し、open の期限が切れていれば half_open の試行を1件だけ通す
+
+        呼び出し時点のタイムアウトを返す（失敗した呼び出しがタイムアウトだったかの判定に使う）。
+        """
+        timeout = self.timeout()
+        with self._lock:
+            if self._state == self.CLOSED:
+                return timeout
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return self.max_timeout
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit for {self.name} is open")
+
+    def _record_success(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._failures = 0
+            self._state = self.CLOSED
+            self._trial_in_flight = False
+
+    def _record_failure(self, latency, timeout):
+        with self._lock:
+            if latency >= timeout:
+                # タイムアウトまで待って失敗した場合は、応答時間が少なくともその長さだったとみなす
+                self._latencies.append(latency)
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
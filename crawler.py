@@ -0,0 +1,91 @@
+"""モッピーの一覧ページを定期的に巡回し、広告一覧をローカルストアに保存するクローラー
+
+使い方:
+    python crawler.py --db snapshot.db                  # 既定のキーワードで1回だけ巡回
+    python crawler.py --db snapshot.db --interval 3600  # 1時間ごとに巡回し続ける
+    python crawler.py --db snapshot.db --keywords-file keywords.txt --url https://pc.moppy.jp/category/...
+"""
+import argparse
+import logging
+import os
+import time
+
+from extract import extract_moppy_listings
+from http_session import SiteSession
+from normalize import Normalizer, canonicalize, load_synonyms
+from snapshot_store import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+MOPPY_SEARCH_URL = "https://pc.moppy.jp/search"
+
+# 既定で巡回する検索キーワード（よく検索されるジャンル）
+DEFAULT_KEYWORDS = [
+    'カード', 'クレジット', 'ポイント', '楽天', '証券', '口座開設', '銀行', '保険',
+    '旅行', 'ホテル', 'ショッピング', '通販', '動画', '光回線', 'ふるさと納税', 'アプリ'
+]
+
+# 1ページから取り出す広告の上限（一覧ページ全体を保存する）
+LISTINGS_PER_PAGE = 500
+
+
+def crawl_once(store, session, keywords, urls=(), delay=1.0):
+    """キーワード検索ページと指定URLの一覧ページを1回ずつ巡回して保存する"""
+    started_at = time.time()
+    saved = 0
+
+    pages = [(MOPPY_SEARCH_URL, {'word': keyword}) for keyword in keywords]
+    pages += [(url, None) for url in urls]
+
+    for url, params in pages:
+        try:
+            html = session.get_text(url, params=params, timeout=30)
+            listings = extract_moppy_listings(html, limit=LISTINGS_PER_PAGE)
+            saved += store.save('moppy', listings, crawled_at=started_at)
+            logger.info("Crawled %s %s: %s listings", url, params or '', len(listings))
+        except Exception as e:
+            logger.error("Error crawling %s %s: %s", url, params or '', e)
+            logger.debug("Traceback for crawl error", exc_info=True)
+        # 相手サイトに負荷をかけないよう間隔をあける
+        time.sleep(delay)
+
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='モッピーの広告一覧をローカルストアに保存する')
+    parser.add_argument('--db', required=True, help='保存先のSQLiteファイル')
+    parser.add_argument('--keywords-file', help='巡回する検索キーワードのファイル（1行1キーワード）')
+    parser.add_argument('--url', action='append', default=[], help='追加で巡回する一覧ページのURL（複数指定可）')
+    parser.add_argument('--interval', type=float, default=0, help='巡回の間隔（秒）。0なら1回だけ実行する')
+    parser.add_argument('--delay', type=float, default=1.0, help='ページ取得ごとの待ち時間（秒）')
+    parser.add_argument('--synonyms', default=os.environ.get('SYNONYMS_PATH'),
+                        help='表記ゆれの表（JSON）。アプリの SYNONYMS_PATH と同じものを指定する（既定は環境変数 SYNONYMS_PATH）')
+    parser.add_argument('--prune-after', type=float, default=7 * 24 * 3600, help='この秒数より前に取得した広告を削除する')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    keywords = DEFAULT_KEYWORDS
+    if args.keywords_file:
+        with open(args.keywords_file, encoding='utf-8') as f:
+            keywords = [line.strip() for line in f if line.strip()]
+
+    # 保存するタイトルの正規化はアプリと同じ表記ゆれの表で行う
+    store = SnapshotStore(args.db, normalize=Normalizer(load_synonyms(args.synonyms)) if args.synonyms else canonicalize)
+    session = SiteSession(pool_size=1)
+
+    while True:
+        saved = crawl_once(store, session, keywords, args.url, delay=args.delay)
+        pruned = store.prune('moppy', time.time() - args.prune_after)
+        logger.info("Crawl finished: %s saved, %s pruned, %s in store", saved, pruned, store.count('moppy'))
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
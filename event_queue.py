@@ -0,0 +1,108 @@
+"""Webhookイベントをバックグラウンドで処理するための作業キュー"""
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueue:
+    """上限付きのイベントキューと、それを処理するワーカースレッド群
+
+    キューが満杯で submit が False を返した場合は、呼び出し側でその場で処理するなどして背圧をかける。
+    応答トークンの有効期限を過ぎたイベントは、処理しても返信できないため破棄する。
+
+    key（イベントから送信元などのキーを返す関数）を指定すると、ワーカーごとにキューを分け、同じキーの
+    イベントは常に同じワーカーが積んだ順に処理する。キューの上限は maxsize をワーカー数で分けたものになる。
+    """
+
+    def __init__(self, dispatch, workers=4, maxsize=100, put_timeout=0.5, max_event_age=50.0, key=None):
+        self.dispatch = dispatch
+        self.workers = workers
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.max_event_age = max_event_age
+        self.key = key
+
+        if key is None:
+            # 全ワーカーで1つのキューを共有する
+            self._queues = [queue.Queue(maxsize=maxsize)]
+        else:
+            shard_size = max(1, -(-maxsize // workers))
+            self._queues = [queue.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # 処理状況のカウンタ
+        self.processed = 0
+        self.rejected = 0
+        self.dropped_stale = 0
+
+    def start(self):
+        """ワーカースレッドを起動する（起動済みなら何もしない）"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                shard = self._queues[i % len(self._queues)]
+                thread = threading.Thread(target=self._worker, args=(shard,), name=f"event-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, event):
+        """イベントをキューに積む。満杯で積めなかった場合は False を返す"""
+        self.start()
+        shard = self._shard(event)
+        try:
+            shard.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            self.rejected += 1
+            logger.warning("Event queue is full (%s), rejecting event", shard.maxsize)
+            return False
+
+        depth = shard.qsize()
+        if depth >= shard.maxsize * 0.8:
+            logger.warning("Event queue depth is high: %s/%s", depth, shard.maxsize)
+        return True
+
+    def is_stale(self, event):
+        """応答トークンの有効期限を過ぎたイベントかどうかを判定する"""
+        if not getattr(event, 'reply_token', None) or not getattr(event, 'timestamp', None):
+            return False
+        age = time.time() - event.timestamp / 1000.0
+        return age > self.max_event_age
+
+    def stats(self):
+        """キューの状態を辞書で返す"""
+        return {
+            'depth': sum(shard.qsize() for shard in self._queues),
+            'maxsize': self.maxsize,
+            'workers': len(self._threads),
+            'shards': len(self._queues),
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'dropped_stale': self.dropped_stale,
+        }
+
+    def _shard(self, event):
+        """イベントを積むキューを返す（同じキーのイベントは同じキュー）"""
+        if len(self._queues) == 1:
+            return self._queues[0]
+        return self._queues[hash(self.key(event)) % len(self._queues)]
+
+    def _worker(self, shard):
+        """キューからイベントを取り出して処理し続ける"""
+        while True:
+            event = shard.get()
+            try:
+                if self.is_stale(event):
+                    self.dropped_stale += 1
+                    logger.warning("Dropping stale event (older than %ss)", self.max_event_age)
+                    continue
+                self.dispatch(event)
+                self.processed += 1
+            except Exception as e:
+                logger.exception("Unexpected error in event worker: %s", e)
+            finally:
+                shard.task_done()
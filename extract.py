@@ -0,0 +1,352 @@
+"""検索結果ページのHTMLから広告情報を抽出する処理"""
+import re
+import time
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+
+MOPPY_BASE_URL = "https://pc.moppy.jp"
+HAPITAS_BASE_URL = "https://sp.hapitas.jp"
+
+# ポイント表記（例: 11,000P）
+POINT_PATTERN = re.compile(r'\d+,?\d*P')
+# 広告カード内のタイトル要素
+TITLE_SELECTOR = 'h3, .item-name, .item-title, [class*="title"]'
+# ナビゲーション要素（「ホーム」「ランキング」などの単純な1単語のタイトル）
+NAV_TITLE_PATTERN = re.compile(r'^[ぁ-んァ-ンー一-龥a-zA-Z]{1,4}$')
+
+# 検索結果エリア（.search-result）のclass属性
+SEARCH_RESULT_CLASS = re.compile(r'(?:^|\s)search-result(?:\s|$)')
+
+# ハピタスの広告詳細ページへのリンク
+HAPITAS_ITEM_LINK_HREF = '/itemDetail/'
+HAPITAS_ITEM_LINK_SELECTOR = f'a[href*="{HAPITAS_ITEM_LINK_HREF}"]'
+
+
+def extract_moppy_results(html, limit=3):
+    """モッピーの検索結果ページから上位limit件の広告（タイトルとURL）を抽出する"""
+    return scan_moppy_results(html, limit)[0]
+
+
+def scan_moppy_results(html, limit=3):
+    """extract_moppy_results と同じ抽出を行い、(抽出結果, 調べた広告カードの数) を返す
+
+    調べたカードがlimit件に達していれば、それ以降のHTMLは結果に影響しない（受信途中の打ち切り判定に使う）。
+    """
+    listings, found = _scan_moppy_listings(html, limit)
+    results = [{'title': truncate_title(listing['title']), 'url': listing['url']} for listing in listings]
+    return results, found
+
+
+def extract_moppy_listings(html, limit=3):
+    """モッピーの一覧ページから上位limit件の広告（切り詰め前のタイトル、URL、ポイント表記）を抽出する"""
+    return _scan_moppy_listings(html, limit)[0]
+
+
+def find_moppy_cards(region, limit):
+    """ポイント表記を含む広告カードを文書順に最大limit件集める
+
+    ポイント表記のテキストから親をたどり、最初に見つかった a 要素か div.item を広告カードとする。
+    同じ内容のカードは1件として数え、limit件見つかった時点で走査を打ち切る。
+    戻り値は (カード要素, 最初に見つかったポイント表記) のリスト。
+    """
+    cards = []
+    point_texts = []
+    seen_ids = set()
+    seen_keys = set()
+    for node in region.descendants:
+        if not isinstance(node, NavigableString) or not POINT_PATTERN.search(node):
+            continue
+
+        # 親要素をたどって広告カード全体を取得
+        parent = node.parent
+        while parent is not None and parent.name != 'a' and not (parent.name == 'div' and 'item' in parent.get('class', [])):
+            parent = parent.parent
+        if parent is None or id(parent) in seen_ids:
+            continue
+        seen_ids.add(id(parent))
+
+        # 同じマークアップのカードも重複として扱う（Tag 同士の == と同じ基準のキーで集合を引く）
+        key = _structural_key(parent)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
+        cards.append(parent)
+        point_texts.append(node.strip())
+        if len(cards) >= limit:
+            break
+
+    return list(zip(cards, point_texts))
+
+
+def _structural_key(node):
+    """要素の名前・属性・子要素（再帰的）から、Tag の == と同じ基準で比較できるハッシュ可能なキーを作る"""
+    if not isinstance(node, Tag):
+        return str(node)
+    attrs = frozenset((name, tuple(value) if isinstance(value, list) else value) for name, value in node.attrs.items())
+    return (node.name, attrs, tuple(_structural_key(child) for child in node.contents))
+
+
+def _scan_moppy_listings(html, limit):
+    """(上位limit件の広告, 調べた広告カードの数) を返す"""
+    region = _moppy_search_region(html)
+    cards = find_moppy_cards(region, limit)
+
+    listings = []
+    seen_urls = set()
+    for card, point_text in cards:
+        listing = _moppy_card_to_listing(card, point_text)
+        if listing and listing['url'] not in seen_urls:
+            seen_urls.add(listing['url'])
+            listings.append(listing)
+
+    return listings[:limit], len(cards)
+
+
+def truncate_title(title, max_length=40):
+    """表示用にタイトルを切り詰める"""
+    if len(title) > max_length:
+        return title[:max_length - 3] + "..."
+    return title
+
+
+def _moppy_search_region(html):
+    """ページ全体をパースして検索結果エリアを返す。エリアがないページはページ全体を返す
+
+    エリアだけを木に組み立てる（SoupStrainer）と、エリアが入れ子・隣接している場合やエリアの外側の
+    要素が広告カードになる場合に従来と違う木になるため、木はページ全体から作る。
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    return soup.select_one('.search-result') or soup
+
+
+def _moppy_card_to_listing(card, point_text):
+    """広告カードからタイトル・URL・ポイント表記を取り出す。広告として扱えない場合は None"""
+    url = None
+
+    # カードがaタグの場合はそのリンク、divタグの場合は中のリンクを使う
+    if card.name == 'a':
+        url = card.get('href')
+    else:
+        link_elem = card.select_one('a')
+        if link_elem:
+            url = link_elem.get('href')
+
+    # タイトル要素を探す
+    title = None
+    title_elem = card.select_one(TITLE_SELECTOR)
+    if title_elem:
+        title = title_elem.get_text(strip=True)
+    else:
+        # 最初のポイント表記でないテキストをタイトルとして使用
+        title = next((text for text in card.stripped_strings if text and not text.endswith('P')), None)
+
+    if not title or not url or NAV_TITLE_PATTERN.match(title):
+        return None
+
+    # 相対URLの場合は絶対URLに変換
+    if not url.startswith('http'):
+        url = f"{MOPPY_BASE_URL}{url}"
+
+    return {
+        'title': title,
+        'url': url,
+        'points': point_text
+    }
+
+
+
+def extract_hapitas_results(html, limit=3):
+    """ハピタスの検索結果ページから上位limit件の広告（タイトルとURL）を抽出する"""
+    return scan_hapitas_results(html, limit)[0]
+
+
+def scan_hapitas_results(html, limit=3):
+    """extract_hapitas_results と同じ抽出を行い、(抽出結果, 調べた広告リンクの数) を返す"""
+    soup = BeautifulSoup(html, 'html.parser')
+    # 検索結果の広告リンク（上位limit件）
+    links = soup.select(HAPITAS_ITEM_LINK_SELECTOR, limit=limit)
+
+    results = []
+    for link in links:
+        title = link.text.strip()
+        url = link.get('href')
+        if not title or not url:
+            continue
+
+        # 相対URLの場合は絶対URLに変換
+        if not url.startswith('http'):
+            url = f"{HAPITAS_BASE_URL}{url}"
+
+        results.append({'title': truncate_title(title), 'url': url})
+
+    return results, len(links)
+
+
+class MoppyCardScanner(HTMLParser):
+    """受信途中のHTMLを少しずつ読み、検索結果エリア内で閉じた広告カードの数を数える
+
+    ポイント表記を含んで閉じた a 要素・div.item を1件と数える（find_moppy_cards と同じ基準）。カードの中に
+    カードがある場合は、外側のカードが閉じて開いているカードがなくなった時点で中のカードと合わせて数え、
+    その終了タグの位置を closed_at に (行, 列) で記録する（閉じ切っていない外側のカードの途中で切らないため）。
+    検索結果エリアが始まるまでは数えず、エリアの要素が閉じて開いているカードもなくなったら finished を True に
+    する（エリアを囲むカードのタイトルがエリアの後にある場合があるため）。
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.region_started = False
+        self.finished = False
+        self.closed = 0
+        self.closed_at = None
+        self._region_closed = False
+        self._pending = 0  # 外側のカードが閉じるのを待っている、閉じたカードの数
+        self._region_tag = None
+        self._region_depth = 0
+        self._stack = []  # 開いている a / div の [タグ名, カードか, ポイント表記を含むか]
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if not self.region_started and SEARCH_RESULT_CLASS.search(attrs.get('class') or ''):
+            self.region_started = True
+            self._region_tag = tag
+        elif tag == self._region_tag and not self._region_closed:
+            self._region_depth += 1
+        if tag == 'a' or tag == 'div':
+            is_card = tag == 'a' or 'item' in (attrs.get('class') or '').split()
+            self._stack.append([tag, is_card, False])
+
+    def handle_endtag(self, tag):
+        if tag == self._region_tag and not self._region_closed:
+            if self._region_depth == 0:
+                self._region_closed = True
+            else:
+                self._region_depth -= 1
+        if tag == 'a' or tag == 'div':
+            while self._stack:
+                name, is_card, has_point = self._stack.pop()
+                if is_card and has_point and self.region_started:
+                    self._pending += 1
+                if name == tag:
+                    break
+        if any(entry[1] for entry in self._stack):
+            return
+        if self._pending:
+            self.closed += self._pending
+            self.closed_at = self.getpos()
+            self._pending = 0
+        if self._region_closed:
+            self.finished = True
+
+    def handle_data(self, data):
+        if not self.region_started or self._region_closed or not POINT_PATTERN.search(data):
+            return
+        for entry in reversed(self._stack):
+            if entry[1]:
+                entry[2] = True
+                break
+
+
+class LinkScanner(HTMLParser):
+    """受信途中のHTMLを少しずつ読み、href に指定の文字列を含む閉じた a 要素の数を数える
+
+    最後に数えた a 要素の終了タグの位置を closed_at に (行, 列) で記録する。
+    """
+
+    finished = False
+
+    def __init__(self, href_contains):
+        super().__init__(convert_charrefs=True)
+        self.href_contains = href_contains
+        self.closed = 0
+        self.closed_at = None
+        self._open = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a' and self.href_contains in (dict(attrs).get('href') or ''):
+            self._open += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._open:
+            self._open -= 1
+            self.closed += 1
+            self.closed_at = self.getpos()
+
+
+class StreamExtractor:
+    """受信途中のHTMLを少しずつ受け取り、上位limit件が確定した時点で抽出を終える
+
+    scan(html, limit) は (抽出結果, 調べた候補要素の数) を返す関数。scanner で閉じた候補要素を数え、
+    limit 件以上閉じたら、受信済みのHTMLを最後に閉じた候補の直後で切って scan する。調べた候補がlimit件に
+    達していれば、先頭limit件の候補はすべて受信済みなので、ページ全体から抽出した場合と同じ結果になる。
+    達していなければ閉じた候補の数が倍になるまで待って scan し直す（抽出の繰り返しは受信量の定数倍に収まる）。
+    scanner が対象エリアの終わりを検出した場合や、最後まで受信して close() した場合は受信した全体から抽出する。
+    """
+
+    def __init__(self, scanner, scan, limit=3):
+        self.scanner = scanner
+        self.scan = scan
+        self.limit = limit
+        self.results = None
+        # 受信を途中で打ち切れたか、抽出（scan の呼び出し）の回数と合計秒数
+        self.stopped_early = False
+        self.extractions = 0
+        self.parse_seconds = 0.0
+
+        self._chunks = []
+        self._next_check = limit
+
+    def feed(self, text):
+        """受信したテキストを渡す。上位limit件が確定して以降の受信が不要になったら True を返す"""
+        if self.results is not None:
+            return True
+        self._chunks.append(text)
+        self.scanner.feed(text)
+        if self.scanner.finished:
+            self.results, _ = self._scan(''.join(self._chunks))
+            self.stopped_early = True
+            return True
+        if self.scanner.closed < self._next_check:
+            return False
+
+        html = ''.join(self._chunks)
+        results, found = self._scan(html[:_end_of_tag(html, self.scanner.closed_at)])
+        if found >= self.limit:
+            self.results = results
+            self.stopped_early = True
+            return True
+        self._next_check = max(self.scanner.closed + self.limit - found, self.scanner.closed * 2)
+        return False
+
+    def close(self):
+        """抽出結果を返す（途中で確定していなければ受信した全体から抽出する）"""
+        if self.results is None:
+            self.results, _ = self._scan(''.join(self._chunks))
+        return self.results
+
+    def _scan(self, html):
+        started = time.perf_counter()
+        try:
+            return self.scan(html, self.limit)
+        finally:
+            self.parse_seconds += time.perf_counter() - started
+            self.extractions += 1
+
+
+def moppy_stream_extractor(limit=3, scan=scan_moppy_results):
+    """モッピーの検索結果ページを受信しながら上位limit件を抽出する StreamExtractor を作る"""
+    return StreamExtractor(MoppyCardScanner(), scan, limit)
+
+
+def hapitas_stream_extractor(limit=3, scan=scan_hapitas_results):
+    """ハピタスの検索結果ページを受信しながら上位limit件を抽出する StreamExtractor を作る"""
+    return StreamExtractor(LinkScanner(HAPITAS_ITEM_LINK_HREF), scan, limit)
+
+
+def _end_of_tag(html, position):
+    """HTMLParser.getpos() の (行, 列) にあるタグの直後の文字位置を返す"""
+    line, column = position
+    offset = 0
+    for _ in range(line - 1):
+        offset = html.index('\n', offset) + 1
+    return html.index('>', offset + column) + 1
@@ -0,0 +1,95 @@
+"""HTMLの抽出をワーカープロセスで行うプール（BeautifulSoupの解析でGILを占有しないため）
+
+検索スレッドは受信したHTMLをUTF-8のバイト列でプールに渡し、(タイトル, URL) のタプルと調べた候補の数だけを
+受け取る。ワーカーは一定件数を処理するごとに作り直し、1件ごとの待ち時間には上限を設ける。
+"""
+import multiprocessing
+import threading
+from multiprocessing import TimeoutError as PoolTimeoutError
+
+from extract import scan_hapitas_results, scan_moppy_results
+
+# サイトIDごとの抽出関数（ワーカープロセス側で使う）
+_SCANNERS = {
+    'moppy': scan_moppy_results,
+    'hapitas': scan_hapitas_results,
+}
+
+
+class ExtractionTimeoutError(Exception):
+    """ワーカープロセスでの抽出が時間内に終わらなかった"""
+
+
+def _scan_in_worker(site, html_bytes, limit):
+    """ワーカープロセスで抽出し、((タイトル, URL), ...) と調べた候補の数を返す"""
+    results, found = _SCANNERS[site](html_bytes.decode('utf-8'), limit)
+    return tuple((result['title'], result['url']) for result in results), found
+
+
+class ExtractionPool:
+    """抽出用のワーカープロセスのプール
+
+    プロセスは最初の抽出時に spawn で起動する（起動済みのスレッドやソケットを子プロセスに引き継がない）。
+    各ワーカーは max_tasks_per_worker 件を処理すると新しいプロセスに入れ替わる。timeout 秒以内に結果が
+    返らない場合は ExtractionTimeoutError を送出する（ワーカー側の処理は止められないため最後まで実行される）。
+    """
+
+    def __init__(self, size=2, timeout=5.0, max_tasks_per_worker=200):
+        self.size = size
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+        # 抽出の件数のカウンタ
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def scan(self, site, html, limit=3):
+        """html からサイトの上位limit件を抽出し、(抽出結果, 調べた候補の数) を返す（extract.scan_* と同じ形）"""
+        job = self._get_pool().apply_async(_scan_in_worker, (site, html.encode('utf-8'), limit))
+        try:
+            results, found = job.get(self.timeout)
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise ExtractionTimeoutError(f"Extraction for {site} did not finish within {self.timeout}s") from None
+        except Exception:
+            self.errors += 1
+            raise
+        self.completed += 1
+        return [{'title': title, 'url': url} for title, url in results], found
+
+    def scanner(self, site):
+        """extract.moppy_stream_extractor などに scan として渡す、サイトを固定した抽出関数を返す"""
+        def scan(html, limit):
+            return self.scan(site, html, limit)
+        return scan
+
+    def close(self):
+        """ワーカープロセスを終了する"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def stats(self):
+        """プールの状態を辞書で返す"""
+        return {
+            'size': self.size,
+            'started': self._pool is not None,
+            'completed': self.completed,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+        }
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.get_context('spawn').Pool(
+                    processes=self.size,
+                    maxtasksperchild=self.max_tasks_per_worker or None
+                )
+            return self._pool
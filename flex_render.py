@@ -0,0 +1,85 @@
+"""検索結果のFlexカルーセルを、SDKのモデルを組み立てずにJSONの雛形から直接作る処理
+
+出力は create_flex_message と CarouselContainer で作った場合の as_json_dict() と同じ内容・同じキー順になる。
+"""
+from functools import lru_cache
+
+from linebot.models import SendMessage
+
+HEADER_COLOR = "#1DB446"
+DETAIL_LABEL = "詳細を見る"
+NO_RESULTS_TEXT = "検索結果がありませんでした。"
+TIMED_OUT_TEXT = "時間内に検索結果を取得できませんでした。"
+
+# サイトごとのバブルを覚えておく件数（サイト×検索結果の組み合わせ）
+BUBBLE_CACHE_SIZE = 2048
+
+
+def _header(site_name):
+    return {"type": "text", "text": site_name, "size": "xl", "weight": "bold", "color": HEADER_COLOR}
+
+
+def _notice_bubble(site_name, text, wrap):
+    notice = {"type": "text", "text": text, "margin": "md"}
+    if wrap:
+        notice["wrap"] = True
+    return {
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "contents": [_header(site_name), notice]}
+    }
+
+
+@lru_cache(maxsize=BUBBLE_CACHE_SIZE)
+def _render_bubble(site_name, items):
+    """(タイトル, URL) のタプル列からバブルの辞書を作る（items が None ならタイムアウト表示）"""
+    if items is None:
+        return _notice_bubble(site_name, TIMED_OUT_TEXT, wrap=True)
+    if not items:
+        return _notice_bubble(site_name, NO_RESULTS_TEXT, wrap=False)
+
+    contents = [_header(site_name)]
+    for i, (title, url) in enumerate(items, 1):
+        contents.append({"type": "text", "text": f"{i}. {title}", "margin": "md", "wrap": True})
+        contents.append({
+            "type": "button",
+            "action": {"type": "uri", "label": DETAIL_LABEL, "uri": url},
+            "margin": "sm",
+            "height": "sm",
+            "style": "primary"
+        })
+    return {
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": contents}
+    }
+
+
+def render_bubble(site_name, results):
+    """サイトの検索結果からバブルの辞書を作る（同じ検索結果なら前回の辞書をそのまま返す）
+
+    返す辞書はキャッシュと共有しているため、呼び出し側で変更しないこと。
+    """
+    items = None if results is None else tuple((result['title'], result['url']) for result in results)
+    return _render_bubble(site_name, items)
+
+
+def render_carousel(site_results):
+    """(サイト名, 検索結果) のリストからカルーセルの辞書を作る"""
+    return {"type": "carousel", "contents": [render_bubble(site_name, results) for site_name, results in site_results]}
+
+
+def cache_info():
+    """バブルのキャッシュの状態を返す"""
+    return _render_bubble.cache_info()
+
+
+class RenderedFlexSendMessage(SendMessage):
+    """作成済みのFlexの辞書をそのまま送るメッセージ（SDKのモデルへの変換を省く）"""
+
+    def __init__(self, alt_text, contents, **kwargs):
+        super(RenderedFlexSendMessage, self).__init__(**kwargs)
+        self.type = 'flex'
+        self.alt_text = alt_text
+        self.contents = contents
+
+    def as_json_dict(self):
+        return {"type": self.type, "altText": self.alt_text, "contents": self.contents}
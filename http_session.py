@@ -0,0 +1,184 @@
+"""サイト取得用の共有HTTPセッション（接続プール・再試行・条件付きリクエスト・受信途中の抽出）"""
+import codecs
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 再試行するステータスコード
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def accept_encoding():
+    """対応している圧縮形式のAccept-Encodingを返す（brotliはライブラリがある場合のみ）"""
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        try:
+            import brotlicffi  # noqa: F401
+        except ImportError:
+            return 'gzip, deflate'
+    return 'gzip, deflate, br'
+
+
+class SiteSession:
+    """スレッド間で共有するHTTPセッション
+
+    同じホストへの接続をキープアライブで使い回し、接続エラー・タイムアウト・429/5xxは指数バックオフで再試行する。
+    再試行は呼び出し側の timeout 秒以内に収まる場合だけ行い、Retry-After の指定は待たない。
+    ETag / Last-Modified を返したページは本文を覚えておき、次回は条件付きリクエストで再検証する。
+    get_extracted は本文を受信しながら抽出し、必要な件数がそろった時点で残りを受信せずに接続を閉じる。
+    """
+
+    def __init__(self, pool_size=8, retries=2, backoff_factor=0.3, validator_cache_size=64, chunk_size=8192):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.chunk_size = chunk_size
+        self.validator_cache_size = validator_cache_size
+
+        # 再試行は get で行う（urllib3 の Retry は Retry-After を上限なく待ち、呼び出しごとの時間の予算を持てないため）
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Accept-Encoding'] = accept_encoding()
+
+        self._validators = OrderedDict()  # URL -> (ETag, Last-Modified, 本文)
+        self._lock = threading.Lock()
+
+        # 条件付きリクエストのカウンタ
+        self.requests = 0
+        self.not_modified = 0
+        # 受信途中の抽出のカウンタ（途中で接続を閉じた回数と、受信した本文のバイト数）
+        self.stopped_early = 0
+        self.bytes_read = 0
+        # 再試行した回数
+        self.retried = 0
+
+    def get(self, url, params=None, timeout=10, **kwargs):
+        """共有セッションでGETリクエストを送る
+
+        接続エラー・タイムアウト・RETRY_STATUSES の応答は最大 retries 回再試行する。待ち時間は
+        backoff_factor * 2^(回数-1) 秒で、待ったあとに timeout 秒（最初の送信からの合計）を超える場合は再試行せず、
+        最後の応答（または例外）をそのまま返す。各回のタイムアウトは残りの時間に収める。
+        """
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while True:
+            remaining = max(deadline - time.monotonic(), 0.001)
+            try:
+                response = self.session.get(url, params=params, timeout=remaining, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not self._can_retry(attempt, deadline):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not self._can_retry(attempt, deadline):
+                    return response
+                response.close()
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+            self.retried += 1
+
+    def _backoff(self, attempt):
+        """attempt 回目の再試行の前に待つ秒数"""
+        return self.backoff_factor * (2 ** attempt)
+
+    def _can_retry(self, attempt, deadline):
+        """再試行の回数が残っていて、待ったあとも timeout 内に時間が残るなら True"""
+        return attempt < self.retries and time.monotonic() + self._backoff(attempt) < deadline
+
+    def get_text(self, url, params=None, timeout=10):
+        """ページ本文を取得する。前回から変更がなければ（304）覚えている本文を返す"""
+        cache_key, headers, cached = self._conditional_headers(url, params)
+        response = self.get(url, params=params, timeout=timeout, headers=headers)
+        self.requests += 1
+
+        if response.status_code == 304 and cached:
+            return self._not_modified(cache_key, cached)
+
+        response.raise_for_status()
+        text = response.text
+        self._remember(cache_key, response, text)
+        return text
+
+    def get_extracted(self, url, extractor, params=None, timeout=10):
+        """ページ本文を受信しながら extractor（extract.StreamExtractor）に渡し、抽出結果を返す
+
+        extractor.feed() が True を返した時点で残りの本文を受信せずに接続を閉じる（その接続はプールに戻らない）。
+        最後まで受信した本文は get_text と同じく条件付きリクエスト用に覚えておき、304 の場合はそれを渡す。
+        """
+        cache_key, headers, cached = self._conditional_headers(url, params)
+        response = self.get(url, params=params, timeout=timeout, headers=headers, stream=True)
+        self.requests += 1
+
+        with response:
+            if response.status_code == 304 and cached:
+                extractor.feed(self._not_modified(cache_key, cached))
+                return extractor.close()
+
+            response.raise_for_status()
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+            chunks = []
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                self.bytes_read += len(chunk)
+                text = decoder.decode(chunk)
+                chunks.append(text)
+                if extractor.feed(text):
+                    self.stopped_early += 1
+                    return extractor.close()
+
+            text = decoder.decode(b'', final=True)
+            chunks.append(text)
+            extractor.feed(text)
+            self._remember(cache_key, response, ''.join(chunks))
+            return extractor.close()
+
+    def _conditional_headers(self, url, params):
+        """(検証情報のキー, 条件付きリクエストのヘッダー, 覚えている (ETag, Last-Modified, 本文)) を返す"""
+        cache_key = requests.Request('GET', url, params=params).prepare().url
+        with self._lock:
+            cached = self._validators.get(cache_key)
+
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return cache_key, headers, cached
+
+    def _not_modified(self, cache_key, cached):
+        """304 が返ったページの覚えている本文を返す"""
+        self.not_modified += 1
+        with self._lock:
+            if cache_key in self._validators:
+                self._validators.move_to_end(cache_key)
+        return cached[2]
+
+    def _remember(self, cache_key, response, text):
+        """ETag / Last-Modified を返したページの本文を覚えておく"""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if (etag or last_modified) and self.validator_cache_size > 0:
+            with self._lock:
+                self._validators[cache_key] = (etag, last_modified, text)
+                self._validators.move_to_end(cache_key)
+                while len(self._validators) > self.validator_cache_size:
+                    self._validators.popitem(last=False)
+
+    def stats(self):
+        """セッションの状態を辞書で返す"""
+        with self._lock:
+            validators = len(self._validators)
+        return {
+            'requests': self.requests,
+            'not_modified': self.not_modified,
+            'stopped_early': self.stopped_early,
+            'bytes_read': self.bytes_read,
+            'retried': self.retried,
+            'validators': validators,
+        }
@@ -0,0 +1,346 @@
+"""/callback への負荷試験（署名付きWebhookの再生と、モッピー・LINE返信APIのスタブ）
+
+モッピーの検索ページとLINEの返信APIの代わりにローカルのスタブサーバーを起動し、正しく署名した
+複数イベントのWebhookを指定したQPSで送り続ける。返信APIのスタブに返信が届くまでの時間を
+イベントごとに計り、スループット・p50/p95/p99・エラー率を表示する。
+
+使い方:
+    # アプリも起動する（スタブの接続先と署名の鍵は環境変数で渡す）
+    python loadtest.py --app-cmd "gunicorn -w 4 -b 127.0.0.1:8000 app:app" --qps 20 --duration 30
+    python loadtest.py --app-cmd "uvicorn asgi:application --port 8000" --qps 200 --moppy-latency 1.0
+
+    # 起動済みのアプリに送る（アプリは MOPPY_SEARCH_URL / LINE_API_ENDPOINT を表示されたスタブに向けておく）
+    python loadtest.py --target http://127.0.0.1:8000 --moppy-port 9001 --line-port 9002
+
+--app-cmd で起動する場合、流量制限と先読みは計測の邪魔になるため、環境変数で指定していなければ無効にする。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'moppy', 'search_medium.html')
+
+# --app-cmd で起動するアプリに既定で渡す設定（計測の邪魔になる制限を外す）
+APP_ENV_DEFAULTS = {
+    'USER_RATE_PER_MINUTE': '0',
+    'LIVE_FETCH_RATE_PER_SECOND': '0',
+    'PREFETCH_INTERVAL_SECONDS': '0',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def sign(body, channel_secret):
+    """Webhookの本文に対する X-Line-Signature を作る"""
+    digest = hmac.new(channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+def build_payload(keywords, events_per_request, rng):
+    """テキストメッセージのイベントを events_per_request 件含むWebhookの本文と、応答トークンのリストを返す"""
+    now = int(time.time() * 1000)
+    events = []
+    for _ in range(events_per_request):
+        reply_token = uuid.uuid4().hex
+        events.append({
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': now,
+            'source': {'type': 'user', 'userId': f"U{uuid.uuid4().hex}"},
+            'webhookEventId': uuid.uuid4().hex,
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'message': {'id': str(rng.randrange(10 ** 15)), 'type': 'text', 'quoteToken': uuid.uuid4().hex,
+                        'text': rng.choice(keywords)},
+        })
+    body = json.dumps({'destination': 'Uloadtest', 'events': events}, ensure_ascii=False).encode('utf-8')
+    return body, [event['replyToken'] for event in events]
+
+
+def percentile(values, p):
+    """p（0〜1）パーセンタイルを返す（値がなければ None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+class Stats:
+    """送信と返信の記録（複数スレッドから更新する）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {}           # 応答トークン -> Webhookを送った時刻
+        self.reply_latencies = []
+        self.reply_kinds = {}       # 返信の種類 -> 件数
+        self.unknown_replies = 0
+        self.webhook_latencies = []
+        self.webhook_errors = {}    # ステータスコードまたは例外名 -> 件数
+        self.requests = 0
+
+    def record_sent(self, reply_tokens, sent_at):
+        with self.lock:
+            for token in reply_tokens:
+                self.sent_at[token] = sent_at
+
+    def record_webhook(self, latency, error=None):
+        with self.lock:
+            self.requests += 1
+            self.webhook_latencies.append(latency)
+            if error is not None:
+                self.webhook_errors[error] = self.webhook_errors.get(error, 0) + 1
+
+    def record_reply(self, reply_token, kind, received_at):
+        with self.lock:
+            sent_at = self.sent_at.pop(reply_token, None)
+            if sent_at is None:
+                self.unknown_replies += 1
+                return
+            self.reply_latencies.append(received_at - sent_at)
+            self.reply_kinds[kind] = self.reply_kinds.get(kind, 0) + 1
+
+    def pending(self):
+        with self.lock:
+            return len(self.sent_at)
+
+
+def reply_kind(messages):
+    """返信内容を「検索結果」か、テキストの先頭部分で分類する"""
+    if any(message.get('type') == 'flex' for message in messages):
+        return 'results'
+    text = messages[0].get('text', '') if messages else ''
+    return f"text: {text[:20]}"
+
+
+def make_moppy_handler(html, latency, jitter, error_rate, rng):
+    """モッピーの検索ページの代わりに保存済みのHTMLを返すハンドラ"""
+    body = html.encode('utf-8')
+
+    class MoppyStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+            if rng.random() < error_rate:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MoppyStubHandler
+
+
+def make_line_handler(stats, latency):
+    """LINEの返信APIの代わりに返信を受け取って記録するハンドラ"""
+
+    class LineStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            received_at = time.perf_counter()
+            length = int(self.headers.get('Content-Length') or 0)
+            data = json.loads(self.rfile.read(length) or b'{}')
+            if self.path.startswith('/v2/bot/message/reply'):
+                stats.record_reply(data.get('replyToken'), reply_kind(data.get('messages', [])), received_at)
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    return LineStubHandler
+
+
+def start_server(handler, port):
+    """スタブサーバーをバックグラウンドのスレッドで起動する"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=f"stub-{server.server_port}", daemon=True).start()
+    return server
+
+
+def start_app(command, env, target, timeout=30.0):
+    """アプリを起動し、/health が応答するまで待つ"""
+    process = subprocess.Popen(shlex.split(command), env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with status {process.returncode}")
+        try:
+            if requests.get(f"{target}/health", timeout=1).ok:
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"App did not become healthy within {timeout}s")
+
+
+def run_load(target, channel_secret, stats, keywords, qps, duration, events_per_request, concurrency, seed):
+    """duration 秒の間、qps 回/秒のペースでWebhookを送る（応答を待たずに次の送信時刻で送る）"""
+    rng = random.Random(seed)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    url = f"{target}/callback"
+
+    def send(body, reply_tokens):
+        headers = {'Content-Type': 'application/json', 'X-Line-Signature': sign(body, channel_secret)}
+        started = time.perf_counter()
+        stats.record_sent(reply_tokens, started)
+        try:
+            response = session.post(url, data=body, headers=headers, timeout=30)
+            error = None if response.ok else str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            error = type(e).__name__
+        stats.record_webhook(time.perf_counter() - started, error)
+        if error is not None:
+            # 受け付けられなかったイベントには返信が来ないため、未着の数えから外す
+            with stats.lock:
+                for token in reply_tokens:
+                    stats.sent_at.pop(token, None)
+
+    started = time.perf_counter()
+    total = int(qps * duration)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as executor:
+        for i in range(total):
+            delay = started + i / qps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            body, reply_tokens = build_payload(keywords, events_per_request, rng)
+            executor.submit(send, body, reply_tokens)
+    return time.perf_counter() - started
+
+
+def format_seconds(value):
+    return '-' if value is None else f"{value * 1000:.1f}ms"
+
+
+def report(stats, elapsed, lost):
+    """結果を表示する"""
+    webhook_errors = sum(stats.webhook_errors.values())
+    replies = len(stats.reply_latencies)
+    events = replies + lost
+    results = stats.reply_kinds.get('results', 0)
+
+    print(f"webhook requests:  {stats.requests} in {elapsed:.1f}s ({stats.requests / elapsed:.1f} req/s)")
+    print(
+        f"webhook latency:   p50 {format_seconds(percentile(stats.webhook_latencies, 0.5))}  "
+        f"p95 {format_seconds(percentile(stats.webhook_latencies, 0.95))}  "
+        f"p99 {format_seconds(percentile(stats.webhook_latencies, 0.99))}"
+    )
+    print(f"webhook errors:    {webhook_errors} ({webhook_errors / max(1, stats.requests):.1%}) {stats.webhook_errors or ''}")
+    print(f"replies:           {replies} of {events} accepted events ({replies / elapsed:.1f} replies/s), {lost} missing ({lost / max(1, events):.1%})")
+    print(
+        f"reply latency:     p50 {format_seconds(percentile(stats.reply_latencies, 0.5))}  "
+        f"p95 {format_seconds(percentile(stats.reply_latencies, 0.95))}  "
+        f"p99 {format_seconds(percentile(stats.reply_latencies, 0.99))}"
+    )
+    print(f"search results:    {results} ({results / max(1, replies):.1%} of replies)")
+    for kind, count in sorted(stats.reply_kinds.items(), key=lambda item: -item[1]):
+        if kind != 'results':
+            print(f"  {count:>6}  {kind}")
+    if stats.unknown_replies:
+        print(f"unknown replies:   {stats.unknown_replies}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/callback への負荷試験')
+    parser.add_argument('--target', default='http://127.0.0.1:8000', help='アプリのURL（/callback を除く）')
+    parser.add_argument('--app-cmd', help='アプリを起動するコマンド。指定するとスタブの接続先を環境変数で渡して起動する')
+    parser.add_argument('--channel-secret', default=os.environ.get('LINE_CHANNEL_SECRET', 'loadtest_secret'),
+                        help='署名に使うチャネルシークレット（アプリと同じもの）')
+    parser.add_argument('--qps', type=float, default=10, help='1秒あたりに送るWebhookの数')
+    parser.add_argument('--duration', type=float, default=30, help='送信を続ける秒数')
+    parser.add_argument('--events-per-request', type=int, default=1, help='1回のWebhookに含めるイベント数（それぞれ別ユーザー）')
+    parser.add_argument('--concurrency', type=int, default=64, help='同時に送信中にできるWebhookの上限')
+    parser.add_argument('--keyword-pool', type=int, default=1000, help='検索キーワードの種類数（多いほどキャッシュに当たりにくい）')
+    parser.add_argument('--keywords-file', help='検索キーワードのファイル（1行1キーワード）。指定すると --keyword-pool は使わない')
+    parser.add_argument('--drain', type=float, default=15, help='送信終了後に返信を待つ秒数の上限')
+    parser.add_argument('--moppy-latency', type=float, default=0.3, help='モッピーのスタブの応答時間（秒）')
+    parser.add_argument('--moppy-jitter', type=float, default=0.1, help='モッピーのスタブの応答時間のばらつき（±秒）')
+    parser.add_argument('--moppy-error-rate', type=float, default=0.0, help='モッピーのスタブが503を返す割合')
+    parser.add_argument('--moppy-fixture', default=FIXTURE_PATH, help='モッピーのスタブが返すHTML')
+    parser.add_argument('--line-latency', type=float, default=0.05, help='LINE返信APIのスタブの応答時間（秒）')
+    parser.add_argument('--moppy-port', type=int, default=0, help='モッピーのスタブのポート（0なら空いているポート）')
+    parser.add_argument('--line-port', type=int, default=0, help='LINE返信APIのスタブのポート（0なら空いているポート）')
+    parser.add_argument('--seed', type=int, default=0, help='乱数のシード')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.keywords_file:
+        with open(args.keywords_file, encoding='utf-8') as f:
+            keywords = [line.strip() for line in f if line.strip()]
+    else:
+        keywords = [f"負荷試験{i}" for i in range(args.keyword_pool)]
+
+    with open(args.moppy_fixture, encoding='utf-8') as f:
+        html = f.read()
+
+    stats = Stats()
+    rng = random.Random(args.seed)
+    moppy = start_server(make_moppy_handler(html, args.moppy_latency, args.moppy_jitter, args.moppy_error_rate, rng),
+                         args.moppy_port)
+    line = start_server(make_line_handler(stats, args.line_latency), args.line_port)
+    moppy_url = f"http://127.0.0.1:{moppy.server_port}/search"
+    line_endpoint = f"http://127.0.0.1:{line.server_port}"
+    logger.info("Stub servers: MOPPY_SEARCH_URL=%s LINE_API_ENDPOINT=%s", moppy_url, line_endpoint)
+
+    process = None
+    if args.app_cmd:
+        env = dict(APP_ENV_DEFAULTS)
+        env.update(os.environ)
+        env.update({
+            'MOPPY_SEARCH_URL': moppy_url,
+            'LINE_API_ENDPOINT': line_endpoint,
+            'LINE_CHANNEL_SECRET': args.channel_secret,
+        })
+        process = start_app(args.app_cmd, env, args.target)
+
+    try:
+        logger.info("Sending %s webhooks/s for %ss (%s events each)", args.qps, args.duration, args.events_per_request)
+        elapsed = run_load(args.target, args.channel_secret, stats, keywords, args.qps, args.duration,
+                           args.events_per_request, args.concurrency, args.seed)
+
+        # 返信がすべて届くか、待ち時間の上限まで待つ
+        deadline = time.monotonic() + args.drain
+        while stats.pending() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        report(stats, elapsed, stats.pending())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        moppy.shutdown()
+        line.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""ログ出力の設定（キュー経由のバックグラウンド出力、JSON形式、リクエストボディの間引きと伏せ字）"""
+import atexit
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# LogRecord が標準で持つ属性（これ以外は extra で渡された項目としてJSONに含める）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにするフォーマッタ"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key in _STANDARD_ATTRS or key.startswith('_'):
+                continue
+            data[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """TEXT_FORMAT の1行に、extra で渡された項目を key=value の形で続けるフォーマッタ"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        extras = [
+            f"{key}={value}" for key, value in record.__dict__.items()
+            if key not in _STANDARD_ATTRS and not key.startswith('_')
+        ]
+        return ' '.join([text] + extras) if extras else text
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """レコードを整形せずにキューへ渡すハンドラ
+
+    標準の QueueHandler は呼び出し元のスレッドでメッセージを整形するため、整形も含めて
+    リスナースレッドに任せる。キューが満杯の場合はレコードを捨てて件数を数える。
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RedactedBody:
+    """ログに出力されるときに初めて伏せ字処理を行うリクエストボディ"""
+
+    def __init__(self, body, fields):
+        self.body = body
+        self.fields = fields
+
+    def __str__(self):
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            return f"<unparseable body: {len(self.body)} chars>"
+        return json.dumps(self._redact(data), ensure_ascii=False)
+
+    def _redact(self, value):
+        if isinstance(value, dict):
+            return {k: '***' if k in self.fields else self._redact(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._redact(v) for v in value]
+        return value
+
+
+class BodySampler:
+    """リクエストボディを一定の割合だけ、伏せ字にしてログに出すための間引き"""
+
+    def __init__(self, rate, redact_fields=()):
+        self.rate = rate
+        self.redact_fields = frozenset(redact_fields)
+
+    def sample(self, body):
+        """ログに出す場合は RedactedBody を、出さない場合は None を返す"""
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return None
+        return RedactedBody(body, self.redact_fields)
+
+
+def setup_logging(level=logging.INFO, fmt='json', queue_size=10000):
+    """ルートロガーをキュー経由の出力に切り替え、出力用のリスナースレッドを起動する"""
+    formatter = JsonFormatter() if fmt == 'json' else TextFormatter()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = BackgroundQueueHandler(log_queue)
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    return queue_handler, listener
@@ -0,0 +1,144 @@
+"""プロセス内のメトリクス（カウンタ・ヒストグラム）とPrometheusテキスト形式での出力"""
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理時間ヒストグラムの既定の区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    """ラベルの辞書を並び順によらないキーに変換する"""
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    """ラベルをPrometheusの {name="value"} 形式にする"""
+    if not key:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in key
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Counter:
+    """ラベルごとに増えていくカウンタ"""
+
+    type_name = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """カウンタを増やす"""
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """(名前, ラベル, 値) の一覧を返す"""
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """ラベルごとに値の分布を記録するヒストグラム"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # ラベル -> [各区切りの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """値を1件記録する"""
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with ブロックの処理時間を記録する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        """(名前, ラベル, 値) の一覧を返す"""
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        samples = []
+        for key, state in values:
+            for bound, count in zip(self.buckets, state):
+                samples.append((f"{self.name}_bucket", key + (('le', repr(float(bound))),), count))
+            samples.append((f"{self.name}_bucket", key + (('le', '+Inf'),), state[-1]))
+            samples.append((f"{self.name}_sum", key, state[-2]))
+            samples.append((f"{self.name}_count", key, state[-1]))
+        return samples
+
+
+class CallbackMetric:
+    """出力のたびに関数から値を読み出すメトリクス（キューの深さやキャッシュの統計など）
+
+    func は [(ラベルの辞書, 値), ...] を返す。
+    """
+
+    def __init__(self, name, help_text, func, type_name='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.type_name = type_name
+
+    def samples(self):
+        """(名前, ラベル, 値) の一覧を返す"""
+        return [(self.name, _label_key(labels), value) for labels, value in self.func()]
+
+
+class MetricsRegistry:
+    """メトリクスをまとめて保持し、Prometheusテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text):
+        """カウンタを作成して登録する"""
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """ヒストグラムを作成して登録する"""
+        return self._register(Histogram(name, help_text, buckets))
+
+    def callback(self, name, help_text, func, type_name='gauge'):
+        """出力時に値を読み出すメトリクスを登録する"""
+        return self._register(CallbackMetric(name, help_text, func, type_name))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """すべてのメトリクスをPrometheusテキスト形式（0.0.4）で返す"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
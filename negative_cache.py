@@ -0,0 +1,132 @@
+"""検索結果が0件だったサイト・キーワードを覚えておくキャッシュ（世代交代するBloomフィルタ）"""
+import hashlib
+import math
+import threading
+import time
+
+
+class _BloomFilter:
+    """ビット列とハッシュ関数k個のBloomフィルタ（double hashing）"""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0  # 追加した件数
+        self.set_bits = 0  # 1になっているビットの数
+        self._array = bytearray((bits + 7) // 8)
+
+    def add(self, h1, h2):
+        for i in range(self.hashes):
+            index = (h1 + i * h2) % self.bits
+            byte, mask = index >> 3, 1 << (index & 7)
+            if not self._array[byte] & mask:
+                self._array[byte] |= mask
+                self.set_bits += 1
+        self.count += 1
+
+    def __contains__(self, hashes):
+        h1, h2 = hashes
+        for i in range(self.hashes):
+            index = (h1 + i * h2) % self.bits
+            if not self._array[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self):
+        """今のビットの埋まり具合から見積もった偽陽性率"""
+        return (self.set_bits / self.bits) ** self.hashes
+
+
+class NegativeCache:
+    """サイトとキーワードをキーに、検索結果が0件だったことを ttl 秒まで覚えておく
+
+    2世代のBloomフィルタを持ち、ttl / 2 秒ごと（または今の世代に capacity 件追加したとき）に古い世代を捨てる。
+    追加したキーは ttl / 2 〜 ttl 秒の間ヒットする。Bloomフィルタなので削除はできず、追加していないキーが
+    まれにヒットする（偽陽性）。偽陽性率が1世代あたり false_positive_rate 以下になるようにビット数を決める。
+    """
+
+    def __init__(self, ttl=60.0, capacity=10000, false_positive_rate=0.001):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.target_false_positive_rate = false_positive_rate
+
+        # 1世代あたりのビット数 m = -n ln(p) / (ln 2)^2 とハッシュ関数の数 k = (m / n) ln 2
+        self.bits = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+
+        self._current = _BloomFilter(self.bits, self.hashes)
+        self._previous = _BloomFilter(self.bits, self.hashes)
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        # ヒット数・追加数・世代交代の回数のカウンタ
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self.rotations = 0
+
+    def add(self, site, keyword):
+        """サイトでキーワードの検索結果が0件だったことを記録する"""
+        hashes = _hashes(site, keyword)
+        with self._lock:
+            self._rotate_if_due()
+            if hashes in self._current:
+                return
+            if self._current.count >= self.capacity:
+                self._rotate()
+            self._current.add(*hashes)
+            self.added += 1
+
+    def contains(self, site, keyword):
+        """サイトでキーワードの検索結果が0件だったと記録されていれば True（偽陽性を含む）"""
+        hashes = _hashes(site, keyword)
+        with self._lock:
+            self._rotate_if_due()
+            if hashes in self._current or hashes in self._previous:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def stats(self):
+        """キャッシュの状態（件数、メモリ使用量、偽陽性率の見積もり）を辞書で返す"""
+        with self._lock:
+            current = self._current.false_positive_rate()
+            previous = self._previous.false_positive_rate()
+            entries = self._current.count + self._previous.count
+        return {
+            'ttl': self.ttl,
+            'entries': entries,
+            'capacity': self.capacity,
+            'memory_bytes': 2 * ((self.bits + 7) // 8),
+            'bits_per_generation': self.bits,
+            'hashes': self.hashes,
+            # 2世代のどちらかで偽陽性になる確率
+            'false_positive_rate': 1 - (1 - current) * (1 - previous),
+            'target_false_positive_rate': self.target_false_positive_rate,
+            'hits': self.hits,
+            'misses': self.misses,
+            'added': self.added,
+            'rotations': self.rotations,
+        }
+
+    def _rotate_if_due(self):
+        elapsed = time.monotonic() - self._rotated_at
+        if elapsed >= self.ttl:
+            # 2世代分の時間が過ぎていれば両方とも期限切れ
+            self._rotate()
+            self._rotate()
+        elif elapsed >= self.ttl / 2:
+            self._rotate()
+
+    def _rotate(self):
+        self._previous = self._current
+        self._current = _BloomFilter(self.bits, self.hashes)
+        self._rotated_at = time.monotonic()
+        self.rotations += 1
+
+
+def _hashes(site, keyword):
+    """キーから double hashing 用の2つの64ビット値を作る"""
+    digest = hashlib.blake2b(f"{site}\0{keyword}".encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
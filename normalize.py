@@ -0,0 +1,106 @@
+"""検索キーワードの正規化（全角半角・ひらがなカタカナ・記号・表記ゆれの統一）
+
+キャッシュ・同時検索のまとめ・カタログの照合・保存済み広告の検索のキーには canonicalize した形を使う。
+canonicalize はかなや記号を大きく寄せるため、サイトへ送る検索語には clean_query で軽く整えた形を使う。
+メッセージ1件につき1回だけ正規化し、返信に表示するキーワードは入力どおりのものを使う。
+"""
+import json
+import logging
+import re
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# ひらがな（ぁ〜ゖ、ゝゞ）をカタカナに写す表
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in list(range(0x3041, 0x3097)) + [0x309D, 0x309E]}
+
+# 文字の間にあれば語を区切らない記号（"U-NEXT" と "UNEXT" を同じにする）
+_JOINERS = frozenset("-'.")
+
+# 文字（英字・かな・漢字）に挟まれた "." と "-"（"U-NEXT" -> "UNEXT"。"1.5倍" の数字の間は残す）
+_LETTER_JOINER = re.compile(r'(?<=[^\W\d_])[.\-](?=[^\W\d_])')
+# 正規形で除く記号（文字に挟まれた "-" "'" "."）と、数字に挟まれていないため区切りとみなす記号
+_CANONICAL_JOINER = re.compile(r"(?<=[^\W\d_])[-'.](?=[^\W\d_])")
+_STRAY_JOINER = re.compile(r"(?<!\d)[-'.]|[-'.](?!\d)")
+
+# 既定の表記ゆれ（正規化後の代表表記 -> 別表記）
+DEFAULT_SYNONYMS = {
+    '三井住友': ['smbc'],
+    'jcb': ['ジェーシービー'],
+    'gu': ['ジーユー'],
+    'unext': ['ユーネクスト'],
+    'nuro': ['ニューロ'],
+    'expedia': ['エクスペディア'],
+    'オイシックス': ['oisix'],
+    'ブランディア': ['brandear'],
+    'ドコモ': ['docomo'],
+    'au': ['エーユー'],
+}
+
+
+def _is_separator(char):
+    """語の区切りとして空白に置き換える文字（句読点・括弧など）かどうか"""
+    return char not in _JOINERS and unicodedata.category(char).startswith('P')
+
+
+def normalize_text(text):
+    """NFKCで全角半角をそろえ、小文字化・カタカナ化し、記号を除いて空白を1つにまとめる
+
+    "-" "'" "." は文字に挟まれていれば除き、数字に挟まれていれば（"1.5倍"）残し、それ以外は区切りとして扱う。
+    """
+    text = unicodedata.normalize('NFKC', text).lower().translate(_HIRAGANA_TO_KATAKANA)
+    text = ''.join(' ' if _is_separator(char) else char for char in text)
+    text = _STRAY_JOINER.sub(' ', _CANONICAL_JOINER.sub('', text))
+    return ' '.join(text.split())
+
+
+def clean_query(text):
+    """サイトへ送る検索語を作る（NFKCで全角半角をそろえ、文字の間の "." "-" を除き、空白を1つにまとめる）"""
+    text = _LETTER_JOINER.sub('', unicodedata.normalize('NFKC', text))
+    return ' '.join(text.split())
+
+
+class Normalizer:
+    """normalize_text のあとに表記ゆれを代表表記に置き換える
+
+    synonyms は {代表表記: [別表記, ...]}。表記はすべて normalize_text を通してから、1つの正規表現にまとめておく。
+    英数字だけの別表記は、前後が英数字でない位置でのみ置き換える（"gu" が "guide" に一致しないように）。
+    """
+
+    def __init__(self, synonyms=None):
+        self.aliases = {}
+        for canonical, aliases in (DEFAULT_SYNONYMS if synonyms is None else synonyms).items():
+            canonical = normalize_text(canonical)
+            for alias in aliases:
+                alias = normalize_text(alias)
+                if alias and alias != canonical:
+                    self.aliases[alias] = canonical
+
+        patterns = []
+        for alias in sorted(self.aliases, key=len, reverse=True):
+            pattern = re.escape(alias)
+            if alias.isascii() and alias.isalnum():
+                pattern = rf'(?<![a-z0-9]){pattern}(?![a-z0-9])'
+            patterns.append(pattern)
+        self._pattern = re.compile('|'.join(patterns)) if patterns else None
+
+    def __call__(self, keyword):
+        """キーワードを代表表記にした正規形を返す"""
+        text = normalize_text(keyword)
+        if self._pattern is None:
+            return text
+        return self._pattern.sub(lambda match: self.aliases[match.group(0)], text)
+
+
+def load_synonyms(path):
+    """表記ゆれの表をJSONファイル（{代表表記: [別表記, ...]}）から読み込み、既定の表に追加する"""
+    with open(path, encoding='utf-8') as f:
+        extra = json.load(f)
+    synonyms = {canonical: list(aliases) for canonical, aliases in DEFAULT_SYNONYMS.items()}
+    for canonical, aliases in extra.items():
+        synonyms.setdefault(canonical, []).extend(aliases)
+    logger.info("Loaded %s synonym entries from %s", len(extra), path)
+    return synonyms
+
+
+canonicalize = Normalizer()
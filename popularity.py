@@ -0,0 +1,202 @@
+"""よく検索されるキーワードの集計（上位K件の頻度スケッチ）と、その検索結果の先読み"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class KeywordSketch:
+    """Space-Saving アルゴリズムで上位のキーワードと検索回数を数える
+
+    覚えておくキーワードは capacity 件まで。満杯のときに新しいキーワードが来たら、回数が最も少ない
+    キーワードを置き換え、その回数を引き継ぐ（実際の回数より多めに数えた分は error に記録する）。
+    回数ごとにキーワードをまとめた表（Stream-Summary）と最小の回数を持ち、record は件数によらず定数時間で終わる。
+    capacity が0以下の場合は何も数えない。
+    """
+
+    def __init__(self, capacity=500):
+        self.capacity = capacity
+        self._counts = {}  # キーワード -> [回数, 誤差]
+        self._buckets = {}  # 回数 -> その回数のキーワード（追加順の dict を順序付き集合として使う）
+        self._min_count = 0
+        self._lock = threading.Lock()
+
+    def record(self, keyword):
+        """キーワードを1回数える"""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            entry = self._counts.get(keyword)
+            if entry is not None:
+                self._move(keyword, entry[0], entry[0] + 1)
+                entry[0] += 1
+                return
+            if len(self._counts) < self.capacity:
+                self._counts[keyword] = [1, 0]
+                self._buckets.setdefault(1, {})[keyword] = None
+                self._min_count = 1
+                return
+            # 回数が最も少ないキーワードのうち、その回数になったのが最も早いものを置き換える
+            floor = self._min_count
+            bucket = self._buckets[floor]
+            victim = next(iter(bucket))
+            del self._counts[victim]
+            self._counts[keyword] = [floor + 1, floor]
+            del bucket[victim]
+            bucket[keyword] = None
+            self._move(keyword, floor, floor + 1)
+
+    def _move(self, keyword, count, new_count):
+        """キーワードを回数 count の組から new_count の組へ移す（ロックを取った状態で呼ぶ）"""
+        bucket = self._buckets[count]
+        del bucket[keyword]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = new_count
+        self._buckets.setdefault(new_count, {})[keyword] = None
+
+    def _rebuild(self):
+        """_counts から回数ごとの組と最小の回数を作り直す（ロックを取った状態で呼ぶ）"""
+        self._buckets = {}
+        for keyword, (count, _) in self._counts.items():
+            self._buckets.setdefault(count, {})[keyword] = None
+        self._min_count = min(self._buckets) if self._buckets else 0
+
+    def top(self, n):
+        """回数の多い順に (キーワード, 回数) を n 件返す"""
+        with self._lock:
+            items = [(keyword, entry[0]) for keyword, entry in self._counts.items()]
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:n]
+
+    def decay(self, factor):
+        """すべての回数に factor をかけ、最近よく検索されたキーワードが上位に来るようにする"""
+        with self._lock:
+            for keyword in list(self._counts):
+                count, error = self._counts[keyword]
+                count = int(count * factor)
+                if count <= 0:
+                    del self._counts[keyword]
+                else:
+                    self._counts[keyword] = [count, min(error, count)]
+            self._rebuild()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._counts)
+
+    def save(self, path):
+        """ファイルに保存する（書き込み途中のファイルを読まれないよう一時ファイルから置き換える）"""
+        with self._lock:
+            data = {'capacity': self.capacity, 'counts': self._counts}
+            text = json.dumps(data, ensure_ascii=False)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """保存したファイルがあれば読み込む（壊れている場合は空のまま始める）"""
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load keyword sketch from %s: %s", path, e)
+            return
+
+        counts = sorted(data.get('counts', {}).items(), key=lambda item: item[1][0], reverse=True)
+        with self._lock:
+            self._counts = {keyword: [int(count), int(error)] for keyword, (count, error) in counts[:max(self.capacity, 0)]}
+            self._rebuild()
+
+
+class PrefetchScheduler:
+    """上位のキーワードの検索結果を、起動時と一定間隔ごとにバックグラウンドで取得し直す
+
+    refresh(keyword) は検索してキャッシュに保存する関数。1回の巡回のあとにスケッチを減衰させ、
+    path を指定した場合はファイルに保存する。
+    """
+
+    def __init__(self, sketch, refresh, top_n=30, interval=240.0, delay=0.5, decay=0.9, path=None):
+        self.sketch = sketch
+        self.refresh = refresh
+        self.top_n = top_n
+        self.interval = interval
+        self.delay = delay
+        self.decay = decay
+        self.path = path
+
+        self._thread = None
+        self._stop = threading.Event()
+
+        # 先読みの実行状況
+        self.rounds = 0
+        self.prefetched = 0
+        self.failed = 0
+        self.last_round_at = None
+
+    def start(self):
+        """バックグラウンドのスレッドを起動する（起動済みなら何もしない）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """スレッドを止めてスケッチを保存する"""
+        self._stop.set()
+        self.save()
+
+    def run_once(self):
+        """上位のキーワードを1回ずつ取得し直す"""
+        for keyword, _ in self.sketch.top(self.top_n):
+            if self._stop.is_set():
+                return
+            try:
+                self.refresh(keyword)
+                self.prefetched += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning("Prefetch failed for %s: %s", keyword, e)
+            # 相手サイトに負荷をかけないよう間隔をあける
+            self._stop.wait(self.delay)
+
+        self.rounds += 1
+        self.last_round_at = time.time()
+        if self.decay < 1:
+            self.sketch.decay(self.decay)
+        self.save()
+
+    def save(self):
+        """path が指定されていればスケッチを保存する"""
+        if not self.path:
+            return
+        try:
+            self.sketch.save(self.path)
+        except OSError as e:
+            logger.warning("Could not save keyword sketch to %s: %s", self.path, e)
+
+    def stats(self):
+        """先読みの状態を辞書で返す"""
+        return {
+            'keywords': len(self.sketch),
+            'top': self.sketch.top(5),
+            'rounds': self.rounds,
+            'prefetched': self.prefetched,
+            'failed': self.failed,
+            'last_round_at': self.last_round_at,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("Unexpected error in prefetch scheduler: %s", e)
+            self._stop.wait(self.interval)
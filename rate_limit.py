@@ -0,0 +1,121 @@
+"""トークンバケットによる流量制限（ユーザーごとの制限と、サイトへの取得全体の予算）"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimitedError(Exception):
+    """流量制限のため処理を行わなかった"""
+
+
+class TokenBucket:
+    """1つのトークンバケット
+
+    毎秒 rate 個ずつ、最大 burst 個までトークンが貯まり、1回の処理で1個使う。rate が0以下なら制限しない。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        # 許可・拒否した回数
+        self.allowed = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        """トークンがあれば1個使って True を返す。なければ False"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.allowed += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def stats(self):
+        """バケットの状態を辞書で返す"""
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+        }
+
+
+class KeyedRateLimiter:
+    """キー（LINEのユーザーIDなど）ごとのトークンバケット
+
+    バケットは最後に使われた順に並べておき、満タンに戻るまでの時間より長く使われていないものと、
+    max_keys を超えた分を古い順に捨てる（満タンのバケットを捨てても結果は変わらない）。
+    1回の判定は償却O(1)。
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_seconds = burst / rate if rate > 0 else 0
+
+        self._buckets = OrderedDict()  # key -> [トークン数, 更新時刻]
+        self._lock = threading.Lock()
+
+        # 許可・拒否した回数と、捨てたバケットの数
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def allow(self, key):
+        """key のトークンがあれば1個使って True を返す。なければ False"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def stats(self):
+        """制限の状態を辞書で返す"""
+        with self._lock:
+            size = len(self._buckets)
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'keys': size,
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'evictions': self.evictions,
+        }
+
+    def _evict_idle(self, now):
+        """先頭（最も長く使われていないもの）から、満タンに戻っているバケットを捨てる"""
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self.idle_seconds:
+                break
+            del self._buckets[key]
+            self.evictions += 1
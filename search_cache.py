@@ -0,0 +1,154 @@
+"""サイト検索結果のキャッシュ（TTL + LRU + stale-while-revalidate）"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SearchCache:
+    """サイトとキーワードをキーにした検索結果キャッシュ（キーワードは normalize.canonicalize 済みのものを渡す）
+
+    ttl 秒以内の結果はそのまま返す。ttl を過ぎても stale_ttl 秒以内であれば古い結果を返しつつ、
+    バックグラウンドで再取得する。上限件数を超えた場合は最も長く使われていないものから捨てる。
+    cache_empty=False の場合、空の結果は保存せず、同じキーに保存済みの結果も捨てる（0件の結果は
+    negative_cache.NegativeCache で短い期間だけ覚える場合のため）。
+    """
+
+    FRESH = 'fresh'
+    STALE = 'stale'
+
+    def __init__(self, maxsize=1000, ttl=300.0, stale_ttl=600.0, refresh_workers=2, cache_empty=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.cache_empty = cache_empty
+
+        self._entries = OrderedDict()  # key -> (結果, 保存時刻)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='cache-refresh')
+
+        # ヒット率のカウンタ
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def get_or_load(self, site, keyword, loader, refresh_loader=None):
+        """キャッシュから結果を返す。なければ loader(keyword) で取得して保存する
+
+        期限切れの結果を返す場合のバックグラウンドの再取得には refresh_loader（省略時は loader）を使う。
+        """
+        if self.maxsize <= 0:
+            return loader(keyword)
+
+        value, status = self.lookup(site, keyword)
+        if status == self.FRESH:
+            return value
+        if status == self.STALE:
+            self.schedule_refresh(site, keyword, refresh_loader or loader)
+            return value
+
+        value = loader(keyword)
+        self.put(site, keyword, value)
+        return value
+
+    def lookup(self, site, keyword):
+        """キャッシュを引いて (結果, 状態) を返し、ヒット率のカウンタを更新する
+
+        状態は FRESH（ttl 以内）、STALE（stale_ttl 以内）、None（なし）のいずれか。
+        STALE の場合の再取得は呼び出し側が行う（asgi.py のように取得方法が異なる場合のため）。
+        """
+        if self.maxsize <= 0:
+            return None, None
+
+        key = (site, keyword)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, self.FRESH
+                if age < self.ttl + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    return value, self.STALE
+            self.misses += 1
+        return None, None
+
+    def schedule_refresh(self, site, keyword, loader):
+        """バックグラウンドのスレッドで loader(keyword) を呼んで結果を更新する（更新中なら何もしない）"""
+        key = (site, keyword)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._refresh_executor.submit(self._refresh, key, keyword, loader)
+
+    def peek(self, site, keyword, allow_stale=True, allow_expired=False):
+        """キャッシュ済みの結果があれば返す（取得は行わない）。なければ None
+
+        allow_expired を指定すると、期限切れでも追い出されていない結果を返す（取得元が使えない場合の代替用）。
+        """
+        key = (site, keyword)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        age = time.monotonic() - stored_at
+        if allow_expired or age < self.ttl or (allow_stale and age < self.ttl + self.stale_ttl):
+            return value
+        return None
+
+    def put(self, site, keyword, value):
+        """結果をキャッシュに保存する"""
+        if self.maxsize <= 0:
+            return
+        key = (site, keyword)
+        with self._lock:
+            if not value and not self.cache_empty:
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """キャッシュの状態を辞書で返す"""
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+    def _refresh(self, key, keyword, loader):
+        """バックグラウンドで結果を再取得する（失敗した場合は古い結果を残す）"""
+        try:
+            value = loader(keyword)
+            self.put(key[0], keyword, value)
+            self.refreshes += 1
+        except Exception as e:
+            logger.warning("Background refresh failed for %s: %s", key, e)
+            logger.debug("Traceback for background refresh failure", exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
@@ -0,0 +1,111 @@
+"""同じキーの同時実行を1回にまとめる（single-flight）"""
+import asyncio
+import functools
+import threading
+
+
+class _Call:
+    """実行中の呼び出し1件分の結果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーで同時に呼ばれた処理を1回だけ実行し、待っている全員に同じ結果を返す
+
+    最初の呼び出しだけが実際に処理を行い、その間に来た呼び出しは完了を待って
+    同じ結果（または同じ例外）を受け取る。完了後の呼び出しは新しく実行される。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        # 実行回数と、まとめられた呼び出しの回数
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        """key が同じ実行中の呼び出しがあればその結果を待ち、なければ func(*args) を実行する"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """実行状況を辞書で返す"""
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            'in_flight': in_flight,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+        }
+
+
+class AsyncSingleFlight:
+    """SingleFlight の asyncio 版（1つのイベントループの中で使う）
+
+    実行中の処理はタスクとして共有する。待っている側が締め切りでキャンセルされても、
+    処理自体は最後まで続ける（結果はキャッシュへの保存などに使われる）。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+        # 実行回数と、まとめられた呼び出しの回数
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args):
+        """key が同じ実行中のタスクがあればその結果を待ち、なければ func(*args) をタスクとして実行する"""
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(func(*args))
+            self._tasks[key] = task
+            self.executed += 1
+            task.add_done_callback(functools.partial(self._finish, key))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # 待っている側が全員キャンセルされた場合でも、例外を未取得のまま残さない
+            task.exception()
+
+    def stats(self):
+        """実行状況を辞書で返す"""
+        return {
+            'in_flight': len(self._tasks),
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,196 @@
+"""クローラーが保存した広告一覧のローカルストア（SQLite + FTS5）"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from extract import truncate_title
+from normalize import canonicalize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT NOT NULL,
+    search_title TEXT NOT NULL DEFAULT '',
+    points TEXT,
+    crawled_at REAL NOT NULL,
+    UNIQUE (site, url)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# 正規化したタイトル（search_title）の全文検索インデックス。正規化の方法が変わったときは作り直す
+FTS_STATEMENTS = (
+    """
+    CREATE VIRTUAL TABLE listings_fts USING fts5(
+        search_title, content='listings', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER listings_ai AFTER INSERT ON listings BEGIN
+        INSERT INTO listings_fts(rowid, search_title) VALUES (new.id, new.search_title);
+    END
+    """,
+    """
+    CREATE TRIGGER listings_ad AFTER DELETE ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+    END
+    """,
+    """
+    CREATE TRIGGER listings_au AFTER UPDATE ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+        INSERT INTO listings_fts(rowid, search_title) VALUES (new.id, new.search_title);
+    END
+    """,
+)
+DROP_FTS_STATEMENTS = (
+    'DROP TRIGGER IF EXISTS listings_ai',
+    'DROP TRIGGER IF EXISTS listings_ad',
+    'DROP TRIGGER IF EXISTS listings_au',
+    'DROP TABLE IF EXISTS listings_fts',
+)
+
+# trigramトークナイザで全文検索できる最短の語の長さ
+MIN_FTS_TERM_LENGTH = 3
+
+
+class SnapshotStore:
+    """サイトごとの広告一覧を保存し、タイトルの全文検索で引けるようにするストア
+
+    タイトルは normalize（normalize.canonicalize と同じ正規化）した形も保存し、検索はその列に対して行う。
+    アプリとクローラーで表記ゆれの表が異なると検索に使う形がずれるため、開いたときの正規化の方法が
+    保存時と違えば、保存済みのタイトルを正規化し直してインデックスを作り直す。
+    接続はスレッドごとに開く。クローラーの書き込み中も読み出せるようにWALモードを使う。
+    """
+
+    def __init__(self, path, normalize=canonicalize):
+        self.path = path
+        self.normalize = normalize
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+        self._ensure_search_titles(conn)
+
+    def _connect(self):
+        """このスレッド用の接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _ensure_search_titles(self, conn):
+        """正規化したタイトルの列とインデックスが今の正規化の方法で作られていなければ作り直す
+
+        複数のプロセスが同時に開いても1つだけが作り直すよう、確認から作り直しまでを1つのトランザクションで行う。
+        """
+        fingerprint = _normalizer_fingerprint(self.normalize)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(listings)')]
+            stored = conn.execute("SELECT value FROM meta WHERE key = 'normalizer'").fetchone()
+            if 'search_title' not in columns or stored is None or stored[0] != fingerprint:
+                # 以前の形式のストア（正規化したタイトルの列がない）か、正規化の方法が変わった
+                for statement in DROP_FTS_STATEMENTS:
+                    conn.execute(statement)
+                if 'search_title' not in columns:
+                    conn.execute("ALTER TABLE listings ADD COLUMN search_title TEXT NOT NULL DEFAULT ''")
+                rows = conn.execute('SELECT id, title FROM listings').fetchall()
+                conn.executemany(
+                    'UPDATE listings SET search_title = ? WHERE id = ?',
+                    [(self.normalize(title), row_id) for row_id, title in rows]
+                )
+                for statement in FTS_STATEMENTS:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('normalizer', ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                    (fingerprint,)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def save(self, site, listings, crawled_at=None):
+        """抽出した広告一覧を保存する（同じURLは上書き）"""
+        if crawled_at is None:
+            crawled_at = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO listings (site, url, title, search_title, points, crawled_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (site, url) DO UPDATE SET
+                    title = excluded.title, search_title = excluded.search_title,
+                    points = excluded.points, crawled_at = excluded.crawled_at
+                """,
+                [
+                    (site, listing['url'], listing['title'], self.normalize(listing['title']), listing.get('points'), crawled_at)
+                    for listing in listings
+                ]
+            )
+        return len(listings)
+
+    def prune(self, site, older_than):
+        """指定時刻より前に取得した広告を削除する"""
+        with self._connect() as conn:
+            cursor = conn.execute('DELETE FROM listings WHERE site = ? AND crawled_at < ?', (site, older_than))
+        return cursor.rowcount
+
+    def search(self, site, keyword, limit=3, max_age=None):
+        """正規化したタイトルにキーワード（正規形。空白区切りはAND）を含む広告を最大limit件返す"""
+        terms = keyword.split()
+        if not terms:
+            return []
+        min_crawled_at = time.time() - max_age if max_age else 0
+
+        if all(len(term) >= MIN_FTS_TERM_LENGTH for term in terms):
+            # すべての語が3文字以上ならtrigramインデックスで検索し、関連度順に並べる
+            query = ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+            rows = self._connect().execute(
+                """
+                SELECT l.title, l.url FROM listings_fts
+                JOIN listings l ON l.id = listings_fts.rowid
+                WHERE listings_fts MATCH ? AND l.site = ? AND l.crawled_at >= ?
+                ORDER BY listings_fts.rank LIMIT ?
+                """,
+                (query, site, min_crawled_at, limit)
+            ).fetchall()
+        else:
+            # 短い語はインデックスが使えないため、取得順にLIKEで探す
+            conditions = ' AND '.join("search_title LIKE ? ESCAPE '\\'" for _ in terms)
+            patterns = ['%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for term in terms]
+            rows = self._connect().execute(
+                f"""
+                SELECT title, url FROM listings
+                WHERE site = ? AND crawled_at >= ? AND {conditions}
+                ORDER BY id LIMIT ?
+                """,
+                (site, min_crawled_at, *patterns, limit)
+            ).fetchall()
+
+        return [{'title': truncate_title(title), 'url': url} for title, url in rows]
+
+    def count(self, site=None):
+        """保存されている広告の件数を返す"""
+        if site is None:
+            return self._connect().execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+        return self._connect().execute('SELECT COUNT(*) FROM listings WHERE site = ?', (site,)).fetchone()[0]
+
+
+def _normalizer_fingerprint(normalize):
+    """正規化の方法（関数の種類と表記ゆれの表）を表す文字列"""
+    kind = type(normalize) if hasattr(normalize, 'aliases') else normalize
+    aliases = sorted(getattr(normalize, 'aliases', {}).items())
+    data = json.dumps([f"{kind.__module__}.{kind.__qualname__}", aliases], ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
@@ -13,6 +13,8 @@ import requests
 from bs4 import BeautifulSoup
 import logging
 import traceback
+from app import site_session
+from extract import hapitas_stream_extractor
 
 logger = logging.getLogger(__name__)
 
@@ -29,37 +31,8 @@ def search_hapitas(keyword):
 }
     
     try:
-        # タイムアウト設定を追加
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        results = []
-        # 検索結果の広告リンクを取得
-        ad_links = soup.select('a[href*="/itemDetail/"]')[:3]  # 上位3件を取得
-        
-        for link in ad_links:
-            # タイトルを取得
-            title = link.text.strip()
-            # URLを取得
-            url = link.get('href')
-            
-            if title and url:
-                # タイトルが長すぎる場合は切り詰める
-                if len(title) > 40:
-                    title = title[:37] + "..."
-                
-                # 相対URLの場合は絶対URLに変換
-                if url and not url.startswith('http'):
-                    url = f"https://sp.hapitas.jp{url}"
-                
-                results.append({
-                    'title': title,
-                    'url': url
-                })
-        
-        return results
+        # アプリと共有のセッションで、本文を受信しながら上位3件の広告リンクがそろった時点で接続を閉じる
+        return site_session.get_extracted(url, hapitas_stream_extractor(limit=3), params=params, timeout=10)
     except Exception as e:
         print("Error searching Hapitas: ", e)
         logger.error(f"Error searching Hapitas: {e}")
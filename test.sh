@@ -68,6 +68,612 @@ except Exception as e:
     print(f'❌ Flexメッセージ作成テスト失敗: {e}')
 "
 
+# 雛形から作るカルーセルのテスト（ネットワーク不要）
+echo "雛形から作るカルーセルのテスト..."
+python -c "
+import json
+import logging
+import app
+from flex_render import render_carousel
+from linebot.models import CarouselContainer
+
+logging.disable(logging.CRITICAL)
+
+results = [
+    {'title': f'テストタイトル{i} 「引用」 & <タグ>', 'url': f'https://example.com/{i}?a=1&b=2'}
+    for i in range(1, 4)
+]
+cases = {
+    'タイムアウト': [('モッピー', None)],
+    '0件': [('モッピー', [])],
+    '1件': [('モッピー', results[:1])],
+    '2件': [('モッピー', results[:2])],
+    '3件': [('モッピー', results)],
+    '複数サイト': [('モッピー', results), ('ハピタス', None), ('ポイントインカム', [])],
+}
+# SDKのモデルで組み立てた場合と同じJSON（キー順を含めてバイト単位で一致）になる
+failed = 0
+for name, site_results in cases.items():
+    for _ in range(2):  # 2回目はキャッシュしたバブルを使う
+        rendered = json.dumps(render_carousel(site_results), ensure_ascii=False)
+        built = json.dumps(
+            CarouselContainer(contents=[app.create_flex_message(site, r) for site, r in site_results]).as_json_dict(),
+            ensure_ascii=False
+        )
+        if rendered.encode('utf-8') != built.encode('utf-8'):
+            failed += 1
+            print(f'❌ {name}: 雛形から作ったJSONがSDKのモデルから作ったJSONと一致しません')
+            break
+if failed == 0:
+    print('✅ 雛形から作ったカルーセルはSDKのモデルから作ったものと一致しました')
+"
+
+# カタログ検索の順位のテスト（ネットワーク不要）
+echo "カタログ検索の順位のテスト..."
+python -c "
+import random
+from catalog import CatalogIndex, DEFAULT_HAPITAS_ADS
+from normalize import canonicalize
+
+def linear_search(ads, keyword, normalize, limit=3):
+    '''インデックスを使わずに全件を走査する従来の優先順位の検索（比較用）'''
+    found = []
+    def add(ad):
+        found.append({'title': ad['title'], 'url': ad['url']})
+    def seen(ad):
+        return any(f['url'] == ad['url'] for f in found)
+    parts = [part for part in keyword.split() if len(part) >= 2]
+    for ad in ads:
+        if keyword in normalize(ad['title']):
+            add(ad)
+    if len(found) < limit:
+        for ad in ads:
+            if keyword in [normalize(k) for k in ad['keywords']] and not seen(ad):
+                add(ad)
+    if len(found) < limit:
+        for ad in ads:
+            if any(part in normalize(ad['title']) for part in parts) and not seen(ad):
+                add(ad)
+            elif any(any(part in normalize(k) for k in ad['keywords']) for part in parts) and not seen(ad):
+                add(ad)
+    if len(found) < limit and ('カード' in keyword or 'クレジット' in keyword):
+        for ad in ads:
+            if ('カード' in normalize(ad['title']) or 'クレジット' in [normalize(k) for k in ad['keywords']]) and not seen(ad):
+                add(ad)
+    if len(found) < limit and 'ポイント' in keyword:
+        for ad in ads:
+            if 'ポイント' in [normalize(k) for k in ad['keywords']] and not seen(ad):
+                add(ad)
+    if len(found) < limit:
+        for ad in ads:
+            if not seen(ad):
+                add(ad)
+    return found[:limit]
+
+rng = random.Random(20240601)
+words = sorted({k for ad in DEFAULT_HAPITAS_ADS for k in ad['keywords']} | {'カード', 'ポイント', 'クレジット', 'Pay', 'ＪＣＢ'})
+alphabet = 'カードポイント楽天光宅配abcJCB'
+
+def synthetic_catalog(size):
+    ads = []
+    for i in range(size):
+        title = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        ads.append({
+            'title': title,
+            # URLの重複も含める（タイトル一致の段はURLで重複を除かない）
+            'url': f'https://example.com/{rng.randrange(size)}',
+            'keywords': rng.sample(words, rng.randint(0, 4)),
+        })
+    return ads
+
+def queries(ads):
+    texts = [ad['title'] for ad in ads] + words
+    yield ''
+    for _ in range(200):
+        text = rng.choice(texts)
+        start = rng.randrange(len(text))
+        yield text[start:start + rng.randint(1, 4)]
+        yield ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        yield ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+
+failed = 0
+catalogs = [('組み込み', DEFAULT_HAPITAS_ADS), ('50件', synthetic_catalog(50)), ('500件', synthetic_catalog(500))]
+for name, ads in catalogs:
+    for normalize in (str.lower, canonicalize):
+        index = CatalogIndex(ads, normalize=normalize)
+        for query in queries(ads):
+            keyword = normalize(query)
+            if index.search(keyword) != linear_search(ads, keyword, normalize):
+                failed += 1
+                print(f'❌ {name}のカタログで {query!r} の検索結果が全件走査と一致しません')
+                break
+if failed == 0:
+    print('✅ カタログ検索の結果は全件走査の結果と一致しました')
+"
+
+# イベントキューの順序のテスト（ネットワーク不要）
+echo "イベントキューの順序のテスト..."
+python -c "
+import logging
+import random
+import threading
+import time
+from types import SimpleNamespace
+from event_queue import EventQueue
+
+logging.disable(logging.CRITICAL)
+
+handled = {}
+lock = threading.Lock()
+done = threading.Event()
+total = 200
+
+def dispatch(event):
+    time.sleep(random.random() * 0.002)
+    with lock:
+        handled.setdefault(event.user, []).append(event.seq)
+        if sum(len(seqs) for seqs in handled.values()) == total:
+            done.set()
+
+# 送信元ごとにキューを分けると、ワーカーが複数でも同じ送信元のイベントは積んだ順に処理される
+event_queue = EventQueue(dispatch, workers=4, maxsize=total, key=lambda event: event.user)
+for seq in range(total):
+    assert event_queue.submit(SimpleNamespace(user=f'U{seq % 7}', seq=seq))
+done.wait(10)
+
+if all(seqs == sorted(seqs) for seqs in handled.values()) and sum(map(len, handled.values())) == total:
+    print(f'✅ {len(handled)}人分のイベントを送信元ごとの順序どおりに処理しました')
+else:
+    print(f'❌ 送信元ごとの順序が崩れました: {handled}')
+"
+
+# キーワード集計のテスト（ネットワーク不要）
+echo "キーワード集計のテスト..."
+python -c "
+import random
+from collections import Counter
+from popularity import KeywordSketch
+
+rng = random.Random(7)
+keywords = [f'キーワード{int(rng.paretovariate(1.1))}' for _ in range(50000)]
+sketch = KeywordSketch(capacity=100)
+for keyword in keywords:
+    sketch.record(keyword)
+exact = Counter(keywords)
+
+# Space-Saving の保証: 数えた回数 - 誤差 <= 実際の回数 <= 数えた回数。全体の1/capacityを超えるキーワードは必ず残る
+failed = [
+    keyword for keyword, (count, error) in sketch._counts.items()
+    if not count - error <= exact[keyword] <= count
+]
+missing = [keyword for keyword, count in exact.items() if count > len(keywords) / sketch.capacity and keyword not in sketch._counts]
+if not failed and not missing and [k for k, _ in sketch.top(3)] == [k for k, _ in exact.most_common(3)]:
+    print('✅ 上位のキーワードと回数の範囲が実際の集計と一致しました')
+else:
+    print(f'❌ キーワード集計が実際と合いません: 範囲外{failed[:5]}, 欠落{missing[:5]}')
+
+# 件数の上限が0なら何も数えない（検索の処理を止めない）
+disabled = KeywordSketch(capacity=0)
+disabled.record('キーワード')
+if len(disabled) == 0:
+    print('✅ 上限0のキーワード集計は何も数えませんでした')
+else:
+    print('❌ 上限0のキーワード集計がキーワードを数えました')
+"
+
+# ASGI版のイベント処理のテスト（ネットワーク不要）
+echo "ASGI版のイベント処理のテスト..."
+python -c "
+import asyncio
+import logging
+import time
+import warnings
+from types import SimpleNamespace
+from linebot.models import MessageEvent, TextMessage
+import asgi
+import app
+
+logging.disable(logging.CRITICAL)
+warnings.simplefilter('ignore')
+
+running = 0
+peak = 0
+handled = []
+
+async def handle_message(event):
+    global running, peak
+    running += 1
+    peak = max(peak, running)
+    await asyncio.sleep(0.01)
+    handled.append(event.message.text)
+    running -= 1
+
+def message(user, text, age=0.0):
+    return MessageEvent(
+        timestamp=int((time.time() - age) * 1000), reply_token='token',
+        source=SimpleNamespace(user_id=user), message=TextMessage(text=text)
+    )
+
+async def main():
+    asgi.handle_message = handle_message
+    asgi._dispatch_slots = asyncio.Semaphore(3)
+    events = [message(f'U{i}', f'検索{i}') for i in range(10)]
+    events.append(message('U-old', '古いイベント', age=app.REPLY_TOKEN_MAX_AGE_SECONDS + 10))
+    await asgi.dispatch_events(events)
+    await asyncio.wait(set(asgi._background_tasks))
+
+asyncio.run(main())
+# 同時に処理する数は上限までで、応答トークンの期限切れのイベントは処理しない
+if peak <= 3 and len(handled) == 10 and '古いイベント' not in handled and asgi.dropped_stale == 1:
+    print(f'✅ 同時に{peak}件まで処理し、期限切れのイベントを破棄しました')
+else:
+    print(f'❌ イベント処理が期待どおりではありません: 同時{peak}件, 処理{len(handled)}件, 破棄{asgi.dropped_stale}件')
+"
+
+# ログ形式のテスト（ネットワーク不要）
+echo "ログ形式のテスト..."
+python -c "
+import json
+import logging
+from log_setup import JsonFormatter, RedactedBody, TextFormatter
+
+body = RedactedBody(json.dumps({'events': [{'replyToken': 'secret', 'type': 'message'}]}), {'replyToken'})
+record = logging.LogRecord('app', logging.INFO, 'app.py', 1, 'Request body', (), None)
+record.body = body
+
+# どちらの形式でも伏せ字にしたリクエストボディが出力される
+text = TextFormatter().format(record)
+data = json.loads(JsonFormatter().format(record))
+if 'body=' in text and '***' in text and 'secret' not in text and data['body'] == str(body):
+    print('✅ テキスト形式・JSON形式ともにリクエストボディを出力しました')
+else:
+    print(f'❌ リクエストボディが出力されていません: {text}')
+"
+
+# 抽出処理のテスト（保存済みのHTMLを使うためネットワーク不要）
+echo "抽出処理のテスト..."
+python -c "
+import json
+import logging
+from extract import extract_hapitas_results, extract_moppy_results, hapitas_stream_extractor
+
+logging.disable(logging.CRITICAL)
+
+# fixtures/*/expected.json には従来の search_moppy・search_hapitas（test.py）の抽出結果を記録している
+failed = 0
+for site, extract in (('moppy', extract_moppy_results), ('hapitas', extract_hapitas_results)):
+    expected = json.load(open(f'fixtures/{site}/expected.json', encoding='utf-8'))
+    for name, results in expected.items():
+        html = open(f'fixtures/{site}/{name}', encoding='utf-8').read()
+        if extract(html) == results:
+            print(f'✅ {site}/{name}: {len(results)}件 一致')
+        else:
+            failed += 1
+            print(f'❌ {site}/{name}: 抽出結果が従来と一致しません')
+
+# ハピタスも受信途中で確定した結果はページ全体からの抽出と一致する
+for name, results in json.load(open('fixtures/hapitas/expected.json', encoding='utf-8')).items():
+    html = open(f'fixtures/hapitas/{name}', encoding='utf-8').read()
+    for chunk_size in (16, 97, 1024):
+        extractor = hapitas_stream_extractor(3)
+        for i in range(0, len(html), chunk_size):
+            if extractor.feed(html[i:i + chunk_size]):
+                break
+        if extractor.close() != results:
+            failed += 1
+            print(f'❌ hapitas/{name}: chunk={chunk_size} の受信途中の抽出結果が一致しません')
+if failed == 0:
+    print('✅ 抽出処理テスト成功')
+"
+
+# 受信途中の抽出のテスト（保存済みのHTMLをローカルのサーバーから少しずつ返すためネットワーク不要）
+echo "受信途中の抽出のテスト..."
+python -c "
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from extract import extract_moppy_results, moppy_stream_extractor
+from http_session import SiteSession
+
+logging.disable(logging.CRITICAL)
+
+expected = json.load(open('fixtures/moppy/expected.json', encoding='utf-8'))
+pages = {name: open(f'fixtures/moppy/{name}', encoding='utf-8').read() for name in expected}
+
+# 断片の大きさや件数を変えても、受信途中で確定した結果はページ全体から抽出した結果と一致する
+failed = 0
+for name, html in pages.items():
+    for limit in (1, 2, 3, 5):
+        for chunk_size in (16, 97, 200, 1024, 16384):
+            extractor = moppy_stream_extractor(limit)
+            for i in range(0, len(html), chunk_size):
+                if extractor.feed(html[i:i + chunk_size]):
+                    break
+            if extractor.close() != extract_moppy_results(html, limit):
+                failed += 1
+                print(f'❌ {name}: limit={limit} chunk={chunk_size} の抽出結果が全体からの抽出と一致しません')
+if failed == 0:
+    print('✅ 受信途中の抽出結果はページ全体からの抽出と一致しました')
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = pages['search_large.html'].encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+session = SiteSession(retries=0)
+results = session.get_extracted(f'http://127.0.0.1:{server.server_port}/search', moppy_stream_extractor(3))
+server.shutdown()
+
+total = len(pages['search_large.html'].encode('utf-8'))
+if results == expected['search_large.html'] and session.stopped_early == 1 and session.bytes_read < total:
+    print(f'✅ 上位3件がそろった時点で受信を打ち切りました（{session.bytes_read}/{total}バイト）')
+else:
+    print(f'❌ 受信を打ち切れませんでした: stopped_early={session.stopped_early}, {session.bytes_read}/{total}バイト')
+"
+
+# サイト取得の再試行のテスト（ネットワーク不要）
+echo "サイト取得の再試行のテスト..."
+python -c "
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_session import SiteSession
+
+hits = []
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        hits.append(time.monotonic())
+        # 最初の1回だけ503を返し、長いRetry-Afterを指定する
+        status = 503 if len(hits) == 1 else 200
+        self.send_response(status)
+        self.send_header('Retry-After', '600')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f'http://127.0.0.1:{server.server_port}/'
+
+# Retry-After は待たずにバックオフだけ待って再試行する
+session = SiteSession(retries=2, backoff_factor=0.1)
+started = time.monotonic()
+text = session.get_text(url, timeout=2)
+elapsed = time.monotonic() - started
+if text == 'ok' and len(hits) == 2 and elapsed < 1:
+    print(f'✅ 503のあとRetry-Afterを待たずに再試行しました（{elapsed:.2f}秒）')
+else:
+    print(f'❌ 再試行が期待どおりではありません: text={text!r}, 送信{len(hits)}回, {elapsed:.2f}秒')
+
+# バックオフを待つとタイムアウトを超える場合は再試行しない
+hits.clear()
+session = SiteSession(retries=2, backoff_factor=1.0)
+started = time.monotonic()
+try:
+    session.get_text(url, timeout=0.5)
+except Exception:
+    pass
+elapsed = time.monotonic() - started
+server.shutdown()
+if len(hits) == 1 and elapsed < 0.5:
+    print(f'✅ タイムアウトに収まらない再試行は行いませんでした（{elapsed:.2f}秒）')
+else:
+    print(f'❌ タイムアウトを超えて再試行しました: 送信{len(hits)}回, {elapsed:.2f}秒')
+"
+
+# ワーカープロセスでの抽出のテスト（ネットワーク不要）
+echo "ワーカープロセスでの抽出のテスト..."
+python -c "
+import json
+from extract import extract_moppy_results
+from extract_pool import ExtractionPool
+
+expected = json.load(open('fixtures/moppy/expected.json', encoding='utf-8'))
+# 1件ごとにワーカーを作り直す設定でも、スレッドで抽出した場合と同じ結果になる
+pool = ExtractionPool(size=2, timeout=30, max_tasks_per_worker=1)
+failed = 0
+for name in expected:
+    html = open(f'fixtures/moppy/{name}', encoding='utf-8').read()
+    results, _ = pool.scan('moppy', html, 3)
+    if results != extract_moppy_results(html):
+        failed += 1
+        print(f'❌ {name}: ワーカープロセスでの抽出結果が一致しません')
+pool.close()
+if failed == 0 and pool.completed == len(expected):
+    print(f'✅ ワーカープロセスで{pool.completed}件抽出し、結果が一致しました')
+"
+
+# 0件の検索結果のキャッシュのテスト（検索関数を差し替えるためネットワーク不要）
+echo "0件の検索結果のキャッシュのテスト..."
+PREFETCH_INTERVAL_SECONDS=0 python -c "
+import logging
+import app
+
+logging.disable(logging.CRITICAL)
+
+# どのサイトでも見つからないキーワードの検索回数を数える
+calls = []
+def not_found(keyword, search_query=None, deadline=None):
+    calls.append(keyword)
+    return []
+app.SEARCH_PROVIDERS = [(site, site_name, not_found) for site, site_name, _ in app.SEARCH_PROVIDERS]
+
+first = app.search_all('あいうえおかきくけこ')
+second = app.search_all('あいうえおかきくけこ')
+if all(results == [] for _, results in first + second) and len(calls) == len(app.SEARCH_PROVIDERS):
+    print('✅ 0件だったキーワードの2回目の検索ではサイトを取得しませんでした')
+else:
+    print(f'❌ 0件だったキーワードを再取得しました: {len(calls)}回')
+if app.search_cache.peek('moppy', 'あいうえおかきくけこ') is None:
+    print('✅ 0件の結果は通常のキャッシュに保存されませんでした')
+else:
+    print('❌ 0件の結果が通常のキャッシュに保存されました')
+stats = app.negative_cache.stats()
+print(f\"偽陽性率の見積もり: {stats['false_positive_rate']:.2e}, メモリ: {stats['memory_bytes']}バイト\")
+"
+
+# 期限切れのキャッシュの再取得のテスト（検索関数を差し替えるためネットワーク不要）
+echo "期限切れのキャッシュの再取得のテスト..."
+PREFETCH_INTERVAL_SECONDS=0 python -c "
+import logging
+import time
+import app
+
+logging.disable(logging.CRITICAL)
+
+# 利用者の締め切りを過ぎてから実行される再取得でも、締め切りで打ち切られずに結果を更新する
+deadlines = []
+def search(keyword, search_query=None, deadline=None):
+    deadlines.append(deadline)
+    app.fetch_timeout(app.site_breakers['moppy'], deadline)
+    return [{'title': '新しい結果', 'url': 'https://example.com/new'}]
+
+app.search_cache.put('moppy', 'さしすせそ', [{'title': '古い結果', 'url': 'https://example.com/old'}])
+value, _ = app.search_cache._entries[('moppy', 'さしすせそ')]
+app.search_cache._entries[('moppy', 'さしすせそ')] = (value, time.monotonic() - app.search_cache.ttl - 1)
+
+stale = app.run_provider('moppy', search, 'さしすせそ', deadline=time.monotonic() - 1)
+for _ in range(100):
+    if app.search_cache.peek('moppy', 'さしすせそ', allow_stale=False):
+        break
+    time.sleep(0.05)
+refreshed = app.search_cache.peek('moppy', 'さしすせそ', allow_stale=False)
+if stale[0]['title'] == '古い結果' and refreshed and refreshed[0]['title'] == '新しい結果' and deadlines == [None]:
+    print('✅ 期限切れの結果を返し、締め切りなしで再取得しました')
+else:
+    print(f'❌ 再取得が期待どおりではありません: {refreshed}, 締め切り{deadlines}')
+"
+
+# サーキットブレーカーのタイムアウト調整のテスト（ネットワーク不要）
+echo "サーキットブレーカーのテスト..."
+python -c "
+import time
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=0.05, min_timeout=0.001, max_timeout=1.0)
+
+def upstream(latency, timeout):
+    time.sleep(min(latency, timeout))
+    if latency > timeout:
+        raise TimeoutError()
+
+# 5msで応答していたサイトが30msかかるようになっても、タイムアウトが伸びて再び成功する
+for _ in range(50):
+    breaker.call(upstream, 0.005, breaker.timeout())
+succeeded = 0
+for _ in range(200):
+    try:
+        breaker.call(upstream, 0.030, breaker.timeout())
+        succeeded += 1
+    except CircuitOpenError:
+        time.sleep(0.005)
+    except TimeoutError:
+        pass
+if breaker.state == CircuitBreaker.CLOSED and succeeded > 100:
+    print(f'✅ 応答が遅くなったサイトに合わせてタイムアウトが伸びました（{succeeded}/200件成功、タイムアウト {breaker.timeout():.3f}秒）')
+else:
+    print(f'❌ 応答が遅くなったサイトを遮断したままです: state={breaker.state}, 成功 {succeeded}/200件')
+"
+
+# 保存済みの広告一覧の検索のテスト（一時ファイルのSQLiteを使うためネットワーク不要）
+echo "保存済みの広告一覧の検索のテスト..."
+python -c "
+import os
+import tempfile
+from normalize import canonicalize
+from snapshot_store import SnapshotStore
+
+store = SnapshotStore(os.path.join(tempfile.mkdtemp(), 'snapshot.db'))
+store.save('moppy', [
+    {'url': 'https://pc.moppy.jp/ad/1', 'title': 'U-NEXT 31日間無料トライアル'},
+    {'url': 'https://pc.moppy.jp/ad/2', 'title': 'ふるさと納税 さとふる'},
+])
+# 表記の違う検索語でも、正規化したタイトルで見つかる
+failed = [q for q in ('unext', 'Ｕ－ＮＥＸＴ 無料', 'フルサト', 'ふるさと納税') if not store.search('moppy', canonicalize(q))]
+if not failed:
+    print('✅ 表記の違う検索語で保存済みの広告が見つかりました')
+else:
+    print(f'❌ 保存済みの広告が見つかりませんでした: {failed}')
+"
+
+# 複数イベントをまとめた配信のテスト（署名付きのペイロードをローカルで処理するためネットワーク不要）
+echo "複数イベント配信のテスト..."
+LINE_CHANNEL_SECRET=test_secret WEBHOOK_DISPATCH_CONCURRENCY=4 python -c "
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+import app
+
+logging.disable(logging.CRITICAL)
+
+# 検索と返信を差し替え、処理順と所要時間だけを記録する
+handled = []
+lock = threading.Lock()
+def fake_search_all(keyword, search_query=None):
+    time.sleep(0.3)
+    return [('モッピー', []), ('ハピタス', [{'title': keyword, 'url': 'https://example.com'}])]
+def fake_send(reply_token, keyword, site_results):
+    with lock:
+        handled.append(reply_token)
+app.search_all = fake_search_all
+app.send_search_results = fake_send
+
+def message_event(user_id, reply_token, text):
+    return {
+        'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': reply_token, 'deliveryContext': {'isRedelivery': False},
+        'replyToken': reply_token,
+        'message': {'id': reply_token, 'type': 'text', 'quoteToken': 'q', 'text': text}
+    }
+
+# ユーザーAが2件、ユーザーBとCが1件ずつ送った配信
+body = json.dumps({'destination': 'Ubot', 'events': [
+    message_event('Ua', 'a1', '楽天'),
+    message_event('Ub', 'b1', 'カード'),
+    message_event('Ua', 'a2', 'ポイント'),
+    message_event('Uc', 'c1', 'GU'),
+]})
+signature = base64.b64encode(hmac.new(b'test_secret', body.encode('utf-8'), hashlib.sha256).digest()).decode('utf-8')
+
+started = time.time()
+response = app.app.test_client().post('/callback', data=body, headers={'X-Line-Signature': signature})
+elapsed = time.time() - started
+
+if response.status_code == 200 and sorted(handled) == ['a1', 'a2', 'b1', 'c1']:
+    print('✅ すべてのイベントを処理しました')
+else:
+    print(f'❌ イベントの処理に失敗しました: status={response.status_code}, handled={handled}')
+if handled.index('a1') < handled.index('a2'):
+    print('✅ 同じユーザーのイベントは順番どおりに処理されました')
+else:
+    print(f'❌ 同じユーザーのイベントの順序が入れ替わりました: {handled}')
+# 逐次処理なら4件 x 0.3秒、並列ならユーザーAの2件分（約0.6秒）で終わる
+if elapsed < 1.0:
+    print(f'✅ 複数ユーザーのイベントを並列に処理しました（{elapsed:.2f}秒）')
+else:
+    print(f'❌ 並列に処理されていません（{elapsed:.2f}秒）')
+"
+
 echo "テスト完了"
 echo "注意: 実際のLINE Botとしての動作確認には、以下が必要です:"
 echo "1. LINE Developers ConsoleでのBotの作成とチャネルアクセストークン、チャネルシークレットの取得"